@@ -5,6 +5,8 @@ from multiprocessing import Process
 from configparser import ConfigParser
 import lst_poller
 import lst_worker
+import ratelimit
+from processes import split_shards, worker_names
 
 
 """
@@ -13,7 +15,8 @@ Expected arguments:
         - config_fp
         - running mode (debug or normal)
 """
-global config_fp, debug_mode, rdb, langs, proj, usr, pssw
+global config_fp, debug_mode, rdb, langs, proj, usr, pssw, poller_opts, shards, \
+    workers, worker_opts, api_opts
 config_fp = debug_mode = None # initialize to avoid NameError
 
 logger = logging.getLogger('app')
@@ -29,8 +32,10 @@ def run():
     set_args()
     load_config()
     logger.info('[RUN] Checked argv and config: OKAY.')
-    Process(target=start_poller).start()
-    Process(target=start_worker).start()
+    for name, shard_langs in split_shards(langs, shards):
+        Process(target=start_poller, args=(name, shard_langs)).start()
+    for name in worker_names(workers):
+        Process(target=start_worker, args=(name,)).start()
 
 
 def set_args():
@@ -63,16 +68,20 @@ def set_args():
         sys.exit(2)
 
 
-def start_poller():
-    logger.info('[START_POLLER] Starting poller on [{}] ({})'.format(proj, \
-        ', '.join(langs)))
-    lst_poller.main(proj, langs, rdb)
+def start_poller(name, shard_langs):
+    logger.info('[START_POLLER] Starting {} on [{}] ({})'.format(name, proj, \
+        ', '.join(shard_langs)))
+    ratelimit.configure(**api_opts)
+    lst_poller.main(proj, shard_langs, rdb, name=name, **poller_opts)
 
 
-def start_worker():
-    logger.info('[START_worker] Starting worker in {} mode'.format \
-        ('DEBUG' if debug_mode else 'normal'))
-    lst_worker.main(rdb, debug_mode, usr, pssw)
+def start_worker(name):
+    logger.info('[START_worker] Starting {} in {} mode'.format(name, \
+        'DEBUG' if debug_mode else 'normal'))
+    # Edits are limited in each process, workers share the edit rate
+    ratelimit.configure(**dict(api_opts, edit_rate=api_opts['edit_rate'] / \
+        max(workers, 1)))
+    lst_worker.main(rdb, debug_mode, usr, pssw, name=name, **worker_opts)
 
 
 def load_config():
@@ -80,13 +89,19 @@ def load_config():
     Load from config file:
         proj    -   project to run on service  (string)
         langs   -   list of languages to run on (list of strings)
+        poller_opts - optional settings of lst_poller (dict)
+        shards  -   number of lst_poller processes (int)
+        workers -   number of lst_worker processes (int)
+        worker_opts - optional settings of lst_worker (dict)
+        api_opts -  optional limits of API requests (dict, see ratelimit)
 
     Additionally we check that both variables are in the list of supported
     projects and languages (also loaded from config file).
 
     Will terminate if options are invalid.
     """
-    global langs, proj, usr, pssw, rdb
+    global langs, proj, usr, pssw, rdb, poller_opts, shards, workers, \
+        worker_opts, api_opts
     try:
         config = ConfigParser()
         config.read_file(open(config_fp))
@@ -107,6 +122,60 @@ def load_config():
             rdb = (host, port, id)
             usr = config.get('credentials', 'username')
             pssw = config.get('credentials', 'password')
+            # Optional poller settings
+            shards = config.getint('poller', 'shards', fallback=1)
+            poller_opts = {
+                'concurrency': config.getint('poller', 'concurrency', \
+                    fallback=4),
+                'queue_size': config.getint('poller', 'queue size', \
+                    fallback=1000),
+                'batch_window': config.getfloat('poller', 'batch window', \
+                    fallback=0.5),
+                'batch_size': config.getint('poller', 'batch size', \
+                    fallback=50),
+                'stall_timeout': config.getint('poller', 'stall timeout', \
+                    fallback=60),
+                'checkpoint_interval': config.getint('poller', \
+                    'checkpoint interval', fallback=10),
+                'mode': config.get('poller', 'detection mode', \
+                    fallback='full'),
+                # Set in [worker], but the poller schedules the pages
+                'grace_period': config.getint('worker', 'grace period', \
+                    fallback=300) }
+            # Optional worker settings
+            workers = config.getint('worker', 'workers', fallback=1)
+            worker_opts = {
+                'claim_idle': config.getint('worker', 'claim idle', \
+                    fallback=900),
+                'resolved_ttl': config.getint('worker', 'resolved ttl', \
+                    fallback=86400),
+                'concurrency': config.getint('worker', 'concurrency', \
+                    fallback=4),
+                'edit_limit': config.getint('worker', 'edit concurrency', \
+                    fallback=1),
+                'batch_size': config.getint('worker', 'batch size', \
+                    fallback=50),
+                'namespaces': config.get('worker', 'namespaces', \
+                    fallback='0').split(),
+                'status_cache': config.getint('worker', 'status ttl', \
+                    fallback=60),
+                'cache_size': config.getint('worker', 'cache size', \
+                    fallback=64),
+                'cache_spill': config.getboolean('worker', 'cache spill', \
+                    fallback=False),
+                'cache_ttl': config.getint('worker', 'cache ttl', \
+                    fallback=3600),
+                'retry': config.getint('worker', 'retry delay', \
+                    fallback=300) }
+            # Optional limits of API requests
+            api_opts = {
+                'read_rate': config.getfloat('api', 'read rate', \
+                    fallback=10.0),
+                'edit_rate': config.getfloat('api', 'edit rate', \
+                    fallback=0.2),
+                'lag': config.getint('api', 'maxlag', fallback=5),
+                'retries': config.getint('api', 'retries', fallback=5),
+                'url': config.get('api', 'url', fallback='') }
         except:
             logger.warning('[LOAD_CONFIG] Unable to load required data from ' \
                 'config [{}]. Terminating'.format(config_fp))
@@ -133,6 +202,11 @@ def load_config():
                 logger.warning('[LOAD_CONFIG] Not supported project [{}]. ' \
                     'Terminating'.format(proj))
                 sys.exit(1)
+            # Unknown detection mode
+            if poller_opts['mode'] not in ('full', 'diff'):
+                logger.warning('[LOAD_CONFIG] Unknown detection mode [{}]. ' \
+                    'Terminating'.format(poller_opts['mode']))
+                sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic wikitext for benchmarks, in every language of localizations.py:
+proofread pages with section labels (localized and English syntax) and
+articles transcluding them with <pages>, {{#lst}} and the localized page
+template. The output only depends on the arguments, so runs are comparable.
+"""
+
+import random
+import re
+from localizations import section_label, template
+
+# Words used in labels, so that labels are in the script of the language
+words = {
+    'de': 'Artikel',
+    'en': 'Article',
+    'es': 'Artículo',
+    'fr': 'Article',
+    'hy': 'Հոդված',
+    'it': 'Articolo',
+    'pl': 'Artykuł',
+    'pt': 'Artigo',
+    'ru': 'Статья'
+    }
+
+# Label in a section tag of labelled_page(), see rename()
+label_re = re.compile(r'=(["\']?)([^"\'<>\n=]*?)\1 />')
+
+filler = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+
+
+def label(lang, i):
+    return '{} {}'.format(words.get(lang, 'Article'), i)
+
+
+def labelled_page(lang, labels, seed=0):
+    """
+    Page with given number of sections, each with a few lines of text.
+    Labels alternate between localized and English syntax (if the language
+    has its own) and are quoted in different ways, like on real wikis.
+    """
+    rnd = random.Random(seed)
+    names = [section_label['en']]
+    if section_label.get(lang):
+        names.append(section_label[lang])
+    text = []
+    for i in range(labels):
+        name = names[i % len(names)]
+        quoted = ('"{}"', "'{}'", '{}')[i % 3].format(label(lang, i))
+        text.append('<{}={} />'.format(name, quoted))
+        text.append("'''{}''', {}".format(label(lang, i).upper(), filler * \
+            rnd.randint(2, 20)))
+        text.append('<section end={} />'.format(quoted))
+    return '\n'.join(text)
+
+
+def renamed_labels(lang, labels, every=10):
+    """
+    Renames of every n-th label of labelled_page() (old label: new label).
+    """
+    return {label(lang, i): label(lang, i) + ' (2)' for i in range(0, \
+        labels, every)}
+
+
+def rename(text, renames):
+    """
+    New revision of a page with the labels renamed (both begin and end tags).
+    """
+    def replace(match):
+        return '={0}{1}{0} />'.format(match.group(1), renames.get( \
+            match.group(2), match.group(2)))
+    return label_re.sub(replace, text)
+
+
+def transcluding_page(lang, directives, volumes=7):
+    """
+    Article transcluding given number of sections, each followed by a
+    paragraph of text. Directives rotate between <pages>, {{#lst}} and the
+    page template of the language (if it has one). Section i is on page i of
+    'Volume <i % volumes>.djvu'.
+    """
+    styles = 3 if template.get(lang) else 2
+    text = []
+    for i in range(directives):
+        index = 'Volume {}.djvu'.format(i % volumes)
+        style = i % styles
+        if style == 0:
+            text.append('<pages index="{}" from={} to={} fromsection="{}" ' \
+                'tosection="{}" />'.format(index, i, i, label(lang, i), \
+                label(lang, i)))
+        elif style == 1:
+            text.append('{{{{#lst:Page:{}/{}|{}}}}}'.format(index, i, \
+                label(lang, i)))
+        else:
+            text.append('{}{}/{}|{}={}}}}}'.format(template[lang][0], index, \
+                i, template[lang][2], label(lang, i)))
+        text.append(filler * 20)
+    return '\n'.join(text)
+
+
+def transcluded_labels(lang, directives, volume=3, volumes=7):
+    """
+    Renames of the sections of one volume in transcluding_page(), to be
+    fixed by lst_worker.fix_transclusion() with title 'Page:Volume <n>.djvu'
+    (all pages of the volume) or transcluded_page() (a single page, only its
+    section is renamed).
+    """
+    return {label(lang, i): label(lang, i) + ' (2)' for i in range(volume, \
+        directives, volumes)}
+
+
+def transcluded_page(directives, volume=3, volumes=7):
+    """
+    Title and page number of the middle page of a volume transcluded in
+    transcluding_page(), or None if the volume is not transcluded.
+    """
+    pages = list(range(volume, directives, volumes))
+    if not pages:
+        return None
+    number = pages[len(pages) // 2]
+    return 'Page:Volume {}.djvu/{}'.format(volume, number), number
+
+
+def titles(count, seed=0):
+    """
+    Titles of pages in all namespaces, with and without page numbers.
+    """
+    rnd = random.Random(seed)
+    forms = ['Page:Volume {}.djvu/{}', 'Page:Volume {}.pdf/{}',
+        'Volume {} article {}', 'Index:Volume {}.djvu', 'Page:Volume {}/{}']
+    return [rnd.choice(forms).format(rnd.randint(1, 30), rnd.randint(1, \
+        900)) for i in range(count)]
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of lst_poller.extract_labels() on large pages with many sections
+(like the volumes of EB1911), compared with the previous line-by-line
+implementation.
+
+Pages are generated by benchmarks/corpus.py.
+
+Run from the root of the repository:
+    python3 -m benchmarks.extract_labels [sections] [repeat] [lang]
+"""
+
+import os
+import re
+import sys
+import timeit
+
+os.makedirs('logs', exist_ok=True)  # Required by lst_poller logger
+import lst_poller
+from localizations import section_label
+from benchmarks import corpus
+
+
+def legacy_extract_labels(wikitext, lang):
+    """
+    extract_labels() as it was before LabelExtractor.
+    """
+    labels = []
+    en_label = section_label['en']
+    loc_label = section_label[lang]
+    for line in wikitext.splitlines():
+        if loc_label and loc_label in line:
+            label = re.search(r'<{}\s?=\s?"?(.*?)"?\s?/>'.format(loc_label), line)
+            if label:
+                labels.append(label.groups()[0])
+        elif en_label in line:
+            label = re.search(r'<{}\s?=\s?"?(.*?)"?\s?/>'.format(en_label), line)
+            if label:
+                labels.append(label.groups()[0])
+    return labels
+
+
+def main(sections=500, repeat=20, lang='en'):
+    page = corpus.labelled_page(lang, sections)
+    # The legacy code doesn't remove single quotes around labels
+    assert [label.strip("'") for label in legacy_extract_labels(page, \
+        lang)] == lst_poller.extract_labels(page, lang)
+    legacy = min(timeit.repeat(lambda: legacy_extract_labels(page, lang), \
+        number=1, repeat=repeat))
+    current = min(timeit.repeat(lambda: lst_poller.extract_labels(page, \
+        lang), number=1, repeat=repeat))
+    print('Page with {} sections ({} kB, {})'.format(sections, \
+        len(page.encode('utf-8'))//1024, lang))
+    print('legacy:\t\t{:.2f} ms'.format(legacy * 1000))
+    print('extractor:\t{:.2f} ms'.format(current * 1000))
+    print('speedup:\t{:.1f}x'.format(legacy / current))
+
+
+if __name__ == '__main__':
+    main(*[int(a) if a.isdigit() else a for a in sys.argv[1:]])
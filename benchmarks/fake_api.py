@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the MediaWiki API (api.php) of several wikis, to run
+lst_poller and lst_worker end to end without touching real wikis.
+
+Implements the requests LST-Guard makes: query with prop=revisions (by
+titles, pageids or revids), prop=transcludedin, prop=info and meta=tokens,
+and action=login, edit and compare. Pages are loaded from a fixture, edits
+create new revisions and are saved to a JSONL file.
+
+Latency, errors (HTTP 503) and maxlag errors can be simulated. Point the
+processes to the server in config.ini:
+
+    [api]
+    url = http://127.0.0.1:8077/{server}/api.php
+
+Run from the root of the repository:
+    python3 -m benchmarks.fake_api <fixture> [--port 8077] [--latency 0.05]
+        [--error-rate 0.01] [--maxlag-rate 0.01] [--edits edits.jsonl]
+
+Fixture is a JSON file (see benchmarks/fixtures/fake_wiki.json):
+    {"<server name>": {"<title>": {"content": "<wikitext>",
+                                   "transcludes": ["<title>", ...],
+                                   "ns": <namespace, optional>}}}
+
+Instead of "content", a page can have "revisions": a list of wikitexts from
+the oldest. Revision ids are numbered from 1 in each wiki, in the order of
+the fixture, so recorded events can refer to them (see
+benchmarks/fixtures/events.jsonl).
+"""
+
+import argparse
+import difflib
+import html
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+# Namespace numbers of title prefixes, others are in main namespace
+namespaces = {'Page': 104, 'Index': 106, 'User': 2, 'Talk': 1}
+
+
+class Wiki:
+    """
+    Pages and revisions of a single wiki. Shared by all request threads.
+    """
+
+    def __init__(self, pages):
+        self.lock = threading.Lock()
+        self.pages = {}         # title: page dict
+        self.by_id = {}         # page id: page dict
+        self.revisions = {}     # revid: (page dict, content, timestamp)
+        self.next_revid = 1
+        for title, page in pages.items():
+            revisions = page.get('revisions') or [page.get('content', '')]
+            created = self.create(title, revisions[0], page.get('ns'))
+            for content in revisions[1:]:
+                self.add_revision(created, content)
+        # Pages transcluded by each page
+        self.transcludes = {title: page.get('transcludes', []) for title, \
+            page in pages.items()}
+
+    def create(self, title, content, ns=None):
+        pageid = len(self.pages) + 1
+        page = {'pageid': pageid, 'title': title, 'ns': namespace(title) if \
+            ns is None else ns, 'revids': []}
+        self.pages[title] = page
+        self.by_id[pageid] = page
+        self.add_revision(page, content)
+        return page
+
+    def add_revision(self, page, content):
+        revid = self.next_revid
+        self.next_revid += 1
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        self.revisions[revid] = (page, content, timestamp)
+        page['revids'].append(revid)
+        return revid
+
+    def find(self, params):
+        """
+        Returns list of (key, page or None) of pages requested by titles or
+        pageids.
+        """
+        if 'titles' in params:
+            return [(title, self.pages.get(title)) for title in \
+                params['titles'].split('|')]
+        return [(pageid, self.by_id.get(int(pageid))) for pageid in \
+            params.get('pageids', '').split('|') if pageid]
+
+    def transcluded_in(self, title):
+        return [self.pages[t] for t, targets in self.transcludes.items() if \
+            title in targets and t in self.pages]
+
+
+def namespace(title):
+    prefix = title.split(':')[0] if ':' in title else ''
+    return namespaces.get(prefix, 0)
+
+
+def missing(key):
+    if isinstance(key, str) and not key.isdigit():
+        return {'ns': namespace(key), 'title': key, 'missing': ''}
+    return {'pageid': int(key), 'missing': ''}
+
+
+def revision(revid, content, timestamp):
+    return {'revid': revid, 'timestamp': timestamp, 'contentformat':
+        'text/x-wiki', 'contentmodel': 'wikitext', '*': content}
+
+
+def query_revisions(wiki, params):
+    pages = {}
+    if 'revids' in params:
+        bad = {}
+        for revid in params['revids'].split('|'):
+            found = wiki.revisions.get(int(revid))
+            if not found:
+                bad[revid] = {'revid': int(revid)}
+                continue
+            page, content, timestamp = found
+            entry = pages.setdefault(str(page['pageid']), {'pageid':
+                page['pageid'], 'ns': page['ns'], 'title': page['title'],
+                'revisions': []})
+            entry['revisions'].append(revision(int(revid), content, timestamp))
+        query = {'pages': pages}
+        if bad:
+            query['badrevids'] = bad
+        return {'query': query}
+    for n, (key, page) in enumerate(wiki.find(params)):
+        if not page:
+            pages[str(-n - 1)] = missing(key)
+            continue
+        revid = page['revids'][-1]
+        _, content, timestamp = wiki.revisions[revid]
+        pages[str(page['pageid'])] = {'pageid': page['pageid'], 'ns':
+            page['ns'], 'title': page['title'], 'revisions': [revision( \
+            revid, content, timestamp)]}
+    return {'query': {'pages': pages}}
+
+
+def query_transcludedin(wiki, params):
+    limit = params.get('tilimit', '10')
+    limit = 500 if limit == 'max' else int(limit)
+    ns = params.get('tinamespace', '*')
+    ns = None if ns == '*' else set(int(n) for n in ns.split('|'))
+    # Continue as '<page id>|<offset>'
+    start = params.get('ticontinue', '0|0').split('|')
+    start_id, offset = int(start[0]), int(start[1])
+    pages = {}
+    result = {}
+    remaining = limit
+    # Pages are continued in order of page id, like in MediaWiki
+    found = sorted(wiki.find(params), key=lambda p: p[1]['pageid'] if p[1] \
+        else 0)
+    for n, (key, page) in enumerate(found):
+        if not page:
+            pages[str(-n - 1)] = missing(key)
+            continue
+        entry = {'pageid': page['pageid'], 'ns': page['ns'], 'title':
+            page['title']}
+        pages[str(page['pageid'])] = entry
+        if page['pageid'] < start_id or 'continue' in result:
+            continue
+        targets = [{'pageid': p['pageid'], 'ns': p['ns'], 'title': \
+            p['title']} for p in wiki.transcluded_in(page['title']) if ns is \
+            None or p['ns'] in ns]
+        first = offset if page['pageid'] == start_id else 0
+        taken = targets[first:first + remaining]
+        if taken:
+            entry['transcludedin'] = taken
+        remaining -= len(taken)
+        if first + len(taken) < len(targets):
+            result['continue'] = {'ticontinue': '{}|{}'.format( \
+                page['pageid'], first + len(taken)), 'continue': '||'}
+    result['query'] = {'pages': pages}
+    return result
+
+
+def query_info(wiki, params):
+    pages = {}
+    for n, (key, page) in enumerate(wiki.find(params)):
+        if not page:
+            pages[str(-n - 1)] = missing(key)
+            continue
+        pages[str(page['pageid'])] = {'pageid': page['pageid'], 'ns':
+            page['ns'], 'title': page['title'], 'lastrevid':
+            page['revids'][-1]}
+    return {'query': {'pages': pages}}
+
+
+def compare(wiki, params):
+    old = wiki.revisions.get(int(params.get('fromrev', 0)))
+    new = wiki.revisions.get(int(params.get('torev', 0)))
+    if not old or not new:
+        return {'error': {'code': 'nosuchrevid', 'info': 'No such revision'}}
+    rows = []
+    matcher = difflib.SequenceMatcher(None, old[1].splitlines(), \
+        new[1].splitlines())
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        deleted = old[1].splitlines()[i1:i2]
+        added = new[1].splitlines()[j1:j2]
+        for n in range(max(len(deleted), len(added))):
+            cells = ''
+            if n < len(deleted):
+                cells += '<td class="diff-deletedline"><div>{}</div></td>' \
+                    .format(html.escape(deleted[n]))
+            if n < len(added):
+                cells += '<td class="diff-addedline"><div>{}</div></td>' \
+                    .format(html.escape(added[n]))
+            rows.append('<tr>{}</tr>'.format(cells))
+    return {'compare': {'fromrevid': int(params['fromrev']), 'torevid':
+        int(params['torev']), '*': '\n'.join(rows)}}
+
+
+class FakeApi(ThreadingHTTPServer):
+    """
+    HTTP server with the wikis of the fixture and simulated problems.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, fixture, latency=0.0, error_rate=0.0,
+        maxlag_rate=0.0, edits_fp=None):
+        super().__init__(address, Handler)
+        self.wikis = {server: Wiki(pages) for server, pages in \
+            fixture.items()}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.maxlag_rate = maxlag_rate
+        self.edits_fp = edits_fp
+        self.edits = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def record_edit(self, server, title, summary, revid):
+        edit = {'server': server, 'title': title, 'summary': summary,
+            'revid': revid, 'time': time.time()}
+        with self.lock:
+            self.edits.append(edit)
+            if self.edits_fp:
+                with open(self.edits_fp, 'a') as f:
+                    f.write(json.dumps(edit, ensure_ascii=False) + '\n')
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api(dict(parse_qsl(urlparse(self.path).query, \
+            keep_blank_values=True)))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        params = dict(parse_qsl(urlparse(self.path).query, \
+            keep_blank_values=True))
+        params.update(parse_qsl(body, keep_blank_values=True))
+        self.handle_api(params)
+
+    def handle_api(self, params):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(random.expovariate(1 / server.latency))
+        if random.random() < server.error_rate:
+            return self.reply(503, {'error': 'Service Unavailable'}, \
+                {'Retry-After': '1'})
+        if 'maxlag' in params and random.random() < server.maxlag_rate:
+            return self.reply(200, {'error': {'code': 'maxlag', 'info':
+                'Waiting for a database server: 6 seconds lagged.'}}, \
+                {'Retry-After': '1', 'X-Database-Lag': '6'})
+        name = urlparse(self.path).path.strip('/').split('/')[0]
+        wiki = server.wikis.get(name)
+        if not wiki:
+            return self.reply(404, {'error': {'code': 'nowiki', 'info':
+                'Unknown wiki {}'.format(name)}})
+        with wiki.lock:
+            self.reply(200, self.dispatch(name, wiki, params))
+
+    def dispatch(self, name, wiki, params):
+        action = params.get('action')
+        if action == 'query':
+            if params.get('meta') == 'tokens':
+                kind = params.get('type', 'csrf')
+                return {'query': {'tokens': {kind + 'token': kind + '+\\'}}}
+            prop = params.get('prop')
+            if prop == 'revisions':
+                return query_revisions(wiki, params)
+            if prop == 'transcludedin':
+                return query_transcludedin(wiki, params)
+            if prop == 'info':
+                return query_info(wiki, params)
+        elif action == 'login':
+            return {'login': {'result': 'Success', 'lgusername':
+                params.get('lgname', '').split('@')[0]}}
+        elif action == 'compare':
+            return compare(wiki, params)
+        elif action == 'edit':
+            return self.edit(name, wiki, params)
+        return {'error': {'code': 'badvalue', 'info': 'Not implemented in ' \
+            'fake API'}}
+
+    def edit(self, name, wiki, params):
+        if params.get('token') != 'csrf+\\':
+            return {'error': {'code': 'badtoken', 'info': 'Invalid CSRF token.'}}
+        if 'pageid' in params:
+            page = wiki.by_id.get(int(params['pageid']))
+            if not page:
+                return {'error': {'code': 'nosuchpageid', 'info':
+                    'There is no page with ID {}.'.format(params['pageid'])}}
+        else:
+            page = wiki.pages.get(params.get('title')) or wiki.create( \
+                params.get('title'), '')
+        # Stricter than MediaWiki, which merges edits of other parts of the
+        # page and ignores conflicts with own edits
+        if params.get('baserevid') and int(params['baserevid']) != \
+            page['revids'][-1]:
+            return {'error': {'code': 'editconflict', 'info': 'Edit ' \
+                'conflict.'}}
+        revid = wiki.add_revision(page, params.get('text', ''))
+        self.server.record_edit(name, page['title'], params.get('summary'), \
+            revid)
+        return {'edit': {'result': 'Success', 'pageid': page['pageid'],
+            'title': page['title'], 'newrevid': revid}}
+
+    def reply(self, status, body, headers=None):
+        content = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake MediaWiki API server.')
+    parser.add_argument('fixture', help='JSON file with pages of the wikis')
+    parser.add_argument('--port', type=int, default=8077)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean ' \
+        'delay of responses in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share' \
+        ' of requests answered with HTTP 503')
+    parser.add_argument('--maxlag-rate', type=float, default=0.0, help= \
+        'share of requests with maxlag refused because of lag')
+    parser.add_argument('--edits', help='JSONL file to save edits to')
+    args = parser.parse_args()
+    with open(args.fixture, encoding='utf-8') as f:
+        fixture = json.load(f)
+    server = FakeApi(('127.0.0.1', args.port), fixture, args.latency, \
+        args.error_rate, args.maxlag_rate, args.edits)
+    print('Fake API of {} on http://127.0.0.1:{}/{{server}}/api.php'.format( \
+        ', '.join(fixture), args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print('Served {} requests, {} edits.'.format(server.requests, \
+        len(server.edits)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of lst_worker.fix_transclusion() on large transcluding pages (like
+the articles of EB1911 collected on a single page), compared with the
+previous line-by-line implementation.
+
+Pages are generated by benchmarks/corpus.py. All renamed sections are on
+pages of one volume, fixed with the title of the volume (the legacy code
+doesn't tell pages of a volume apart).
+
+Run from the root of the repository:
+    python3 -m benchmarks.fix_transclusion [directives] [repeat]
+"""
+
+import os
+import re
+import sys
+import timeit
+
+os.makedirs('logs', exist_ok=True)  # Required by lst_worker logger
+import lst_worker
+from lst_worker import clean_title
+from localizations import template
+from benchmarks import corpus
+
+
+def legacy_fix_transclusion(page_content, title, labels, lang):
+    """
+    fix_transclusion() as it was before TransclusionParser.
+    """
+    page_content = page_content.splitlines()
+    title = clean_title(title)
+    corrected_labels = {}
+    edited = False
+
+    for line in page_content:
+        if title in line:
+            index = page_content.index(line)
+
+            if line.startswith('<pages index'):
+                for label in labels.keys():
+                    if label in line:
+                        pattern = (r'(<pages index\s?=\s?"?{}"?\s.*?fromsection'
+                            r'\s?=\s?"?)({}|.*)("?\s?tosection\s?=\s?"?)({}|.*)'
+                            r'("?\s?/>)'.format(re.escape(title), label, label))
+                        match = re.search(pattern, line)
+                        if match:
+                            line = (re.sub(r'([from|to]section\s?=\s?"?){}'
+                                .format(label), r'\1{}'.format(labels[label]),
+                                line, count=2))
+                            page_content[index] = line
+                            corrected_labels[label] = labels[label]
+                            edited = True
+
+            if line.startswith('{{#lst:') or line.startswith('{{#lstx'):
+                for label in labels.keys():
+                    if label in line:
+                        pattern = (r'({{#lstx?:)(\w+:)?({})(/\d*)?([|]{})(}})'
+                            .format(title, label))
+                        match = re.search(pattern, line)
+                        if match:
+                            line = re.sub(pattern, r'\1\2\3\4|{}\6'.format
+                                (labels[label]), line)
+                            page_content[index] = line
+                            corrected_labels[label] = labels[label]
+                            edited = True
+
+            if template[lang] and line.lower().startswith(template[lang][0]):
+                for label in labels.keys():
+                    if label in line:
+                        pattern = (r'({}{})(/\d*)?(.*?)([|])(\w+)(\s?=\s?)({})'
+                            r'(.*?}}$)'.format(template[lang][1], title, label))
+                        match = re.match(pattern, line)
+                        if match and match.group(5) in template[lang][2:]:
+                            line = (re.sub(pattern, r'\1\2\3\4\5\6{}\8'.format
+                                (labels[label]), line))
+                            page_content[index] = line
+                            corrected_labels[label] = labels[label]
+                            edited = True
+
+    page_content = '\n'.join(page_content)
+    if edited:
+        return page_content, corrected_labels
+    return None, None
+
+
+def main(directives=2000, repeat=5):
+    page = corpus.transcluding_page('en', directives)
+    title = 'Page:Volume 3.djvu'    # Matches all pages of the volume
+    labels = corpus.transcluded_labels('en', directives)
+    new = lst_worker.fix_transclusion(page, title, labels, 'en')
+    assert new[1] == labels
+    legacy = min(timeit.repeat(lambda: legacy_fix_transclusion(page, title, \
+        labels, 'en'), number=1, repeat=repeat))
+    current = min(timeit.repeat(lambda: lst_worker.fix_transclusion(page, \
+        title, labels, 'en'), number=1, repeat=repeat))
+    print('Page with {} directives ({} kB), {} changed labels'.format( \
+        directives, len(page)//1024, len(labels)))
+    print('legacy:\t\t{:.2f} ms'.format(legacy * 1000))
+    print('parser:\t\t{:.2f} ms'.format(current * 1000))
+    print('speedup:\t{:.1f}x'.format(legacy / current))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
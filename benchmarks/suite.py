@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark suite of the text hot paths on a synthetic corpus (see
+benchmarks/corpus.py), in every language of localizations.py:
+
+    extract_labels      lst_poller.extract_labels() on pages with N labels
+    check_revision      lst_poller.check_revision() on two revisions of a page
+                        with N labels (every tenth renamed), revisions are
+                        served from memory instead of the API
+    fix_transclusion    lst_worker.fix_transclusion() on articles with N
+                        directives, renamed labels are on every page of a
+                        volume, only those of one page of it are fixed
+    clean_title         lst_worker.clean_title() on N titles (not per
+                        language)
+    write_data          lst_poller.write_data() with N/10 renamed labels, only
+                        with --db (Redis host and port are read from
+                        config.ini, keys written by the benchmark are deleted)
+
+Results are saved as JSON (best and median seconds per call of each case).
+compare runs the suite again (or reads a second results file) and flags
+cases slower than the baseline by more than the threshold.
+
+Run from the root of the repository:
+    python3 -m benchmarks.suite run [--out results.json] [options]
+    python3 -m benchmarks.suite compare <baseline.json> [results.json]
+        [--threshold 0.2] [options]
+
+Options:
+    --langs en,hy   languages (default all)
+    --sizes 1,5000  sizes N (default 1,50,500,5000 labels, directives are
+                    capped at 2000)
+    --only a,b      benchmarks to run (default all)
+    --repeat 5      measurements per case
+    --db 15         Redis db for write_data (don't use the db of running
+                    workers!)
+"""
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+
+os.makedirs('logs', exist_ok=True)  # Required by loggers of lst_*
+import redis
+import lst_poller
+import lst_worker
+from localizations import section_label
+from benchmarks import corpus
+
+sizes = [1, 50, 500, 5000]
+max_directives = 2000
+min_time = 0.02     # Seconds of a single measurement, see measure()
+min_change = 10e-6  # Seconds, smaller changes are noise, see compare()
+
+
+class CorpusRevisions:
+    """
+    Serves revisions of the corpus to lst_poller.get_diff() in place of its
+    RevisionBatcher, so check_revision() is timed without API requests.
+    """
+
+    def __init__(self, old_text, new_text):
+        self.texts = (old_text, new_text)
+
+    def get(self, revids):
+        return self.texts
+
+
+def measure(func, repeat):
+    """
+    Times func(), called as many times as needed for min_time seconds per
+    measurement. Returns tuple of best and median seconds per call.
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    times = [elapsed / number]
+    for r in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return min(times), statistics.median(times)
+
+
+def case_extract_labels(lang, n):
+    page = corpus.labelled_page(lang, n)
+    assert len(lst_poller.extract_labels(page, lang)) == n
+    return len(page), lambda: lst_poller.extract_labels(page, lang)
+
+
+def case_check_revision(lang, n):
+    old = corpus.labelled_page(lang, n)
+    renames = corpus.renamed_labels(lang, n)
+    new = corpus.rename(old, renames)
+    url = 'https://{}.wikisource.org/w/api.php'.format(lang)
+    revids = {'old': 1, 'new': 2}
+    lst_poller.batchers[url] = CorpusRevisions(old, new)
+    assert lst_poller.check_revision(revids, url, lang) == renames
+    return len(old), lambda: lst_poller.check_revision(revids, url, lang)
+
+
+def case_fix_transclusion(lang, n):
+    page = corpus.transcluding_page(lang, n)
+    renames = corpus.transcluded_labels(lang, n)
+    # A single page, directives of other pages of the volume are skipped
+    title, number = corpus.transcluded_page(n) or ('Page:Volume 3.djvu/3', 3)
+    if renames:
+        old = corpus.label(lang, number)
+        assert lst_worker.fix_transclusion(page, title, renames, lang)[1] == \
+            {old: renames[old]}
+    return len(page), lambda: lst_worker.fix_transclusion(page, title, \
+        renames, lang)
+
+
+def case_clean_title(lang, n):
+    titles = corpus.titles(n)
+    def run():
+        for title in titles:
+            lst_worker.clean_title(title)
+    return sum(len(t) for t in titles), run
+
+
+def case_write_data(lang, n):
+    renames = corpus.renamed_labels(lang, n) or {'a': 'b'}
+    url = 'https://{}.wikisource.org/w/api.php'.format(lang)
+    written = []
+    def run():
+        item = {'title': 'Benchmark:{}'.format(len(written)), 'lang': lang,
+            'url': url, 'labels': renames}
+        written.append(lst_poller.page_key(item))
+        lst_poller.write_data(item)
+    return len(renames), run, written
+
+
+benchmarks = {
+    'extract_labels': case_extract_labels,
+    'check_revision': case_check_revision,
+    'fix_transclusion': case_fix_transclusion,
+    'clean_title': case_clean_title,
+    'write_data': case_write_data
+    }
+
+
+def open_redis(db):
+    """
+    Opens Redis db on the host and port from config.ini, registers the merge
+    script of lst_poller. Returns None if Redis is not available.
+    """
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    host = config.get('redis database', 'host', fallback='localhost')
+    port = config.get('redis database', 'port', fallback='6379')
+    try:
+        r = redis.StrictRedis(host, port, db)
+        r.ping()
+    except redis.exceptions.RedisError as e:
+        print('Redis not available ({}), skipping write_data'.format(e))
+        return None
+    lst_poller.redb = r
+    lst_poller.merge_script = r.register_script(lst_poller.merge_lua)
+    return r
+
+
+def delete_written(r, keys):
+    """
+    Deletes data of pages written by write_data benchmark.
+    """
+    for i in range(0, len(keys), 500):
+        batch = keys[i:i + 500]
+        pipe = r.pipeline()
+        for key in batch:
+            pipe.delete('lstdata:labels:' + key, 'lstdata:info:' + key, \
+                'lstdata:origins:' + key)
+        pipe.srem('lstdata:pages', *batch)
+        pipe.zrem('lstdata:schedule', *batch)
+        pipe.execute()
+
+
+def run(langs, case_sizes, only, repeat, db=None):
+    """
+    Runs the benchmarks, prints each result. Returns results as dict.
+    """
+    # Keep the logs of the benchmarked functions quiet
+    lst_poller.logger.setLevel(logging.WARNING)
+    lst_worker.logger.setLevel(logging.WARNING)
+    r = open_redis(db) if db is not None and 'write_data' in only else None
+    results = {}
+    print('{:<30}{:>15}{:>15}'.format('case', 'best', 'median'))
+    for name in only:
+        if name == 'write_data' and not r:
+            continue
+        # Titles are the same in all languages
+        for lang in (['-'] if name == 'clean_title' else langs):
+            for n in case_sizes:
+                if name == 'fix_transclusion':
+                    n = min(n, max_directives)
+                key = '{}/{}/{}'.format(name, lang, n)
+                if key in results:
+                    continue
+                case = benchmarks[name](lang, n)
+                try:
+                    best, median = measure(case[1], repeat)
+                finally:
+                    if name == 'write_data':
+                        delete_written(r, case[2])
+                results[key] = {'best': best, 'median': median, 'size': \
+                    case[0]}
+                print('{:<30}{:>12.3f} ms{:>12.3f} ms'.format(key, best * \
+                    1000, median * 1000))
+    lst_poller.batchers.clear()
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(), 'machine': platform.machine(),
+        'repeat': repeat, 'results': results}
+
+
+def compare(baseline, current, threshold):
+    """
+    Prints the change of each case in both results. Returns list of keys of
+    cases slower than the baseline by more than threshold (eg. 0.2 is 20%)
+    and by more than min_change seconds.
+    """
+    regressions = []
+    base = baseline['results']
+    print('{:<30}{:>15}{:>15}{:>9}'.format('case', 'baseline', 'current', \
+        'change'))
+    for key, result in current['results'].items():
+        if key not in base:
+            continue
+        change = result['best'] / base[key]['best'] - 1
+        significant = abs(result['best'] - base[key]['best']) > min_change
+        flag = ''
+        if change > threshold and significant:
+            regressions.append(key)
+            flag = 'REGRESSION'
+        elif change < -threshold and significant:
+            flag = 'faster'
+        print('{:<30}{:>12.3f} ms{:>12.3f} ms{:>+9.0%}  {}'.format(key, \
+            base[key]['best'] * 1000, result['best'] * 1000, change, flag))
+    print('{} regression(s) over {:.0%}'.format(len(regressions), threshold))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of LST-Guard ' \
+        'text processing.')
+    parser.add_argument('command', choices=['run', 'compare'])
+    parser.add_argument('files', nargs='*', help='compare: baseline and ' \
+        'optionally results to compare with it (default: run now)')
+    parser.add_argument('--out', help='file to save results to')
+    parser.add_argument('--langs', default=','.join(section_label))
+    parser.add_argument('--sizes', default=','.join(str(s) for s in sizes))
+    parser.add_argument('--only', default=','.join(benchmarks))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--db', type=int, help='Redis db for write_data')
+    args = parser.parse_args()
+
+    only = args.only.split(',')
+    unknown = [name for name in only if name not in benchmarks]
+    if unknown or (args.command == 'compare' and len(args.files) not in \
+        (1, 2)) or (args.command == 'run' and args.files):
+        print(__doc__)
+        sys.exit(2)
+    if args.command == 'compare' and len(args.files) == 2:
+        with open(args.files[1]) as f:
+            results = json.load(f)
+    else:
+        results = run(args.langs.split(','), [int(s) for s in \
+            args.sizes.split(',')], only, args.repeat, args.db)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.command == 'compare':
+        with open(args.files[0]) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,12 @@
 import redis
 import subprocess
 import sys
-from time import sleep
+import time
 from configparser import ConfigParser
+import processes
 
-global redb, redb_host, redb_port, redb_id, proc_args, config_fp
+global redb, redb_host, redb_port, redb_id, proc_args, config_fp, pollers, \
+    workers
 config_fp = 'config.ini'
 proc_args = ['nohup', 'python3', 'app.py', config_fp, 'normal', '&']
 
@@ -27,6 +29,7 @@ ARGUMENTS:
         -start             Start service
         -stop              Stop service, processes will finilize and stop
         -restart           Restart service, processes will finilize and restart
+        -reload            Reload localizations.py without stopping the service
         -redis             Show is Redis-server is running and available data
         -help              Print this message
 
@@ -59,6 +62,7 @@ def run():
     run_option = {  '-start':start_lstg,
                     '-stop':stop_lstg,
                     '-restart':restart_lstg,
+                    '-reload':reload_lstg,
                     '-status':get_status,
                     '-redis':check_redis
                     }
@@ -85,7 +89,7 @@ def check_argv(options):
     elif sys.argv[1] in ('-start','-restart') and len(sys.argv)==3 and sys.argv[2] not in ('--debug','-d'):
         print('Unrecognized argument "{}". Use "-help" for help'.format(sys.argv[2]))
         sys.exit(2)
-    elif sys.argv[1] in ('-stop','-status','-help') and len(sys.argv)==3:
+    elif sys.argv[1] in ('-stop','-status','-reload','-help') and len(sys.argv)==3:
         print('Unrecognized argument "{}". Use "-help" for help'.format(sys.argv[2]))
         sys.exit(2)
 
@@ -106,25 +110,11 @@ def open_redis():
             (redb_host, redb_port, redb_id))
 
 
-def lock_redis(unlock=False):
-    if unlock:
-        redb.set('locked', 0)
-    else:
-        # Check if locked is set
-        if not redb.get('locked'):
-            redb.set('locked', 0 if unlock else 1)
-        elif int(redb.get('locked')):
-            print('Waiting for Redb to unlock...', end=' ', flush=True)
-            waited = 0
-            while (int(redb.get('locked'))):
-                sleep(0.01)
-                waited += 1
-                if waited > 1000: # we waited 10s
-                    print('\nError: Unable to lock Redb. Terminating.' \
-                    'Check variable "locked".')
-                    sys.exit(1)
-            print('OK')
-        redb.set('locked', 1)
+def get_processes():
+    """
+    Names of all processes, as used for their status in Redis.
+    """
+    return [name for name, langs in pollers] + workers
 
 
 def check_redis(option=None):
@@ -145,8 +135,15 @@ def check_redis(option=None):
 
 
 def start_lstg(option=False):
-    print('Flushing Redis database.')
-    redb.flushdb()
+    # Only status of previous run is cleared. Stream position (so lst_poller
+    # continues where it stopped) and lstdata:* (changed labels, schedule and
+    # pending pages) are kept, flush with -redis --flush to start over.
+    stale = [k for k in redb.scan_iter() if not k.startswith(b'lstdata:') \
+        and b'_checkpoint_' not in k]
+    if stale:
+        redb.delete(*stale)
+    print('Cleared status of previous run. Kept stream checkpoint(s) and ' \
+        'label data.')
     if option in ('--debug','-d'):
         debug_mode = True
         proc_args[4] = 'debug'
@@ -155,45 +152,94 @@ def start_lstg(option=False):
     print(proc_args)
     subprocess.Popen(proc_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, \
         stderr=subprocess.PIPE )
-    lock_redis()
-    redb.set('poller_status', 'starting')
-    redb.set('worker_status', 'starting')
-    lock_redis(unlock=True)
-    print('Starting LST-guard: lst_poller & lst_worker initiated.')
+    redb.mset({'{}_status'.format(name): 'starting' for name in \
+        get_processes()})
+    print('Starting LST-guard: lst_poller ({} shard(s)) & lst_worker ({}) ' \
+        'initiated.'.format(len(pollers), len(workers)))
     if debug_mode:
         print('Note: lst_worker runs in debug mode, edits will be saved in ' \
             'debug file. Check [lst_worker.py] for filepath.')
 
 
+def send_command(command, answer, timeout=60):
+    """
+    Publishes command on Redis channel lstg:control (received by all running
+    processes) and waits until each of them answers on channel lstg:ack.
+
+    Returns list of processes that answered, or None on timeout.
+    """
+    pubsub = redb.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe('lstg:ack')
+    receivers = redb.publish('lstg:control', command)
+    answered = []
+    deadline = time.monotonic() + timeout
+    while len(answered) < receivers:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            pubsub.close()
+            return None
+        message = pubsub.get_message(timeout=remaining)
+        if message:
+            name, status = message['data'].decode('utf-8').split(' ', 1)
+            if status == answer and name not in answered:
+                answered.append(name)
+    pubsub.close()
+    return answered
+
+
 def restart_lstg(option=False):
-    stop_lstg()
-    print('Waiting for processes to stop. This might take 5-20 seconds...')
-    still_running = True
-    while(still_running):
-        sleep(2)
-        if redb.get('poller_status').decode('utf-8') == 'stopped' \
-            and redb.get('worker_status').decode('utf-8') == 'stopped':
-            still_running = False
-    print('All processes stopped. Preparing to restart service.')
+    if not stop_lstg():
+        print('Not restarting. Check status of processes with -status.')
+        sys.exit(1)
+    print('Preparing to restart service.')
     start_lstg(option)
 
 
 def stop_lstg():
-    lock_redis()
-    redb.set('poller_status', 'stopping')
-    redb.set('worker_status', 'stopping')
-    lock_redis(unlock=True)
-    print('Stopping LST-guard: signal sent to lst_poller & lst_worker.')
+    print('Stopping LST-guard: signal sent to lst_poller & lst_worker. ' \
+        'Waiting for processes to stop...')
+    stopped = send_command('stop', 'stopped')
+    if stopped is None:
+        print('Error: not all processes stopped in time.')
+        return False
+    print('All processes stopped ({}).'.format(', '.join(stopped) if stopped \
+        else 'none was running'))
+    return True
+
+
+def reload_lstg():
+    reloaded = send_command('reload', 'reloaded')
+    if reloaded is None:
+        print('Error: not all processes reloaded in time.')
+    else:
+        print('Reloaded localizations in: {}.'.format(', '.join(reloaded) if \
+            reloaded else 'none (no process is running)'))
 
 
 def get_status():
-    poller = 'Not started' if not redb.get('poller_status') \
-        else redb.get('poller_status').decode('utf-8')
-    worker = 'Not started' if not redb.get('worker_status') \
-        else redb.get('worker_status').decode('utf-8')
-    print('\nProcesses:\tStatus:\nlst_poller\t{}\nlst_worker\t{}\n'.format \
-        (poller.upper(),worker.upper()))
-    if worker == 'running debug mode':
+    print('\nProcesses:\tStatus:')
+    for name, langs in pollers:
+        status = redb.get('{}_status'.format(name))
+        status = status.decode('utf-8') if status else 'Not started'
+        print('lst_{}\t{}\t({})'.format(name, status.upper(), ', '.join(langs)))
+    debug = False
+    for name in workers:
+        worker = 'Not started' if not redb.get('{}_status'.format(name)) \
+            else redb.get('{}_status'.format(name)).decode('utf-8')
+        print('lst_{}\t{}'.format(name, worker.upper()))
+        debug = debug or worker == 'running debug mode'
+    print()
+    # Saved by each process every minute, see ratelimit.report_rates()
+    rates = {name: redb.hgetall('lstdata:rates:{}'.format(name)) for name in \
+        get_processes()}
+    if any(rates.values()):
+        print('API requests per second (current/maximum):')
+        for name, process_rates in rates.items():
+            for wiki, rate in sorted(process_rates.items()):
+                print('lst_{}\t{}\t{}'.format(name, wiki.decode('utf-8'), \
+                    rate.decode('utf-8')))
+        print()
+    if debug:
         print('Note: lst_worker runs in debug mode. Check [lst_worker.py] for' \
             ' filepath.')
 
@@ -257,6 +303,12 @@ def check_config():
                 sys.exit(1)
 
         print('Check: config file [{}]: OK.'.format(config_fp))
+        global pollers, workers
+        pollers = processes.split_shards(config.get('run on', \
+            'languages').split(), config.getint('poller', 'shards', \
+            fallback=1))
+        workers = processes.worker_names(config.getint('worker', 'workers', \
+            fallback=1))
         return (config.get('redis database', 'host'), \
                 config.get('redis database', 'port'), \
                 config.get('redis database', 'db'))
@@ -1,18 +1,56 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import html
+import importlib
 import json
-import requests
 import time
 import re
 import redis
 import logging
 import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
 from sseclient import SSEClient as EventSource
+import localizations
+import ratelimit
 from localizations import section_label
 
-global proc_name, redb
+global proc_name, redb, edit_queue, executors, batchers, extractors, \
+    page_lanes, lanes_lock, accepted_servers, checkpoint, source, \
+    detection_mode, merge_script, section_label, grace, observe_only, \
+    queue_slots
 proc_name = 'poller'
+grace = 300                     # Seconds before a changed page is due
+observe_only = False            # Set when recording, see check_edit()
+stop_event = threading.Event()      # Set by listen_control()
+latency = {'edits': 0, 'total': 0.0, 'max': 0.0}  # See record_latency()
+latency_lock = threading.Lock()
+reload_event = threading.Event()    # Set by listen_control()
+detection_mode = 'full'         # 'full' or 'diff', see check_edit()
+source = None                   # Current stream connection, see read_stream()
+min_backoff = 1                 # Seconds to wait before reconnecting stream,
+max_backoff = 300               # doubled after each failed attempt
+batchers = {}                   # RevisionBatcher per API url, see get_diff()
+extractors = {}                 # LabelExtractor per language
+accepted_servers = set()        # Server names of watched wikis
+page_lanes = {}                 # Pending edits per page, see schedule_edit()
+lanes_lock = threading.Lock()   # Guards page_lanes
+queue_slots = None              # Limits edits waiting to be checked, taken
+                                # in main(), released by run_lane()
+
+# Used by prefilter_event() on raw event data
+server_name_re = re.compile(r'"server_name"\s*:\s*"([^"\\]*)"')
+namespace_re = re.compile(r'"namespace"\s*:\s*(-?\d+)')
+timestamp_re = re.compile(r'"timestamp"\s*:\s*(\d+)')
+
+# Used by get_compare() on diff tables
+diff_row_re = re.compile(r'<tr>(.*?)</tr>', re.DOTALL)
+diff_cell_re = re.compile(r'<td class="diff-(deletedline|addedline)[^"]*">' \
+    r'(.*?)</td>', re.DOTALL)
+html_tag_re = re.compile(r'<[^>]*>')
 
 logger = logging.getLogger('poller')
 _h = logging.FileHandler('logs/poller.log')
@@ -22,63 +60,407 @@ logger.setLevel(logging.INFO)
 logger.propagate = False
 
 
-def main(proj, langs, db_params):
+def main(proj, langs, db_params, concurrency=4, queue_size=1000,
+    batch_window=0.5, batch_size=50, stall_timeout=60, checkpoint_interval=10,
+    mode='full', name='poller', grace_period=300, events=None, recorder=None):
     """
     Main routine. Reads the recent changes stream from EventSource (includes
     edits from all wikimedia projects), filters out edits in the specified
     project and langauge(s) and sends further through the pipline to check
     for modified section labels.
 
+    The routine only reads and filters events. Matching edits are put in a
+    bounded queue and are checked by a pool of threads (see dispatch_edits()),
+    so the stream is never blocked by API requests.
+
     Required arguments:
     - proj (string)                 - the Wikimedia project to watch on
     - langs (list of strings)       - the language versions of project
     - dp_parms (tuple of 3 strings) - host, port and id of Redis db
 
-    After each 100 edits, checks redis status, if stop signal is received will
-    exit.
+    Optional arguments:
+    - concurrency (int)             - max number of edits checked in parallel
+                                      in each wiki
+    - queue_size (int)              - max number of edits waiting to be checked
+    - batch_window (float)          - seconds to collect revisions before
+                                      fetching them in one API request
+    - batch_size (int)              - max revision ids in one API request
+    - stall_timeout (int)           - seconds without events after which the
+                                      stream is reconnected
+    - checkpoint_interval (int)     - seconds between saving stream position
+    - mode (string)                 - 'full' to compare full revision texts,
+                                      'diff' to look at the diff first (see
+                                      check_revision_diff())
+    - name (string)                 - name of the process (differs for each
+                                      shard), used for its keys in Redis
+    - grace_period (int)            - seconds to wait after a detected change
+                                      before workers check the page (editors
+                                      might fix transclusions by hand)
+    - events (iterable)             - events to read instead of the live
+                                      stream (see replay.ReplaySource), the
+                                      poller stops when they run out
+    - recorder (replay.Recorder)    - saves every event read, changed
+                                      labels and the stream position are
+                                      not saved in Redis while recording
+
+    The position of the last processed event is saved in Redis, so after a
+    restart the stream continues from where it stopped (see read_stream()).
+
+    Listens to commands of lst_manager in a separate thread (see
+    listen_control()). If stop signal is received will exit.
     """
     # Open Redis
-    global redb
+    global redb, edit_queue, executors, batchers, checkpoint, detection_mode, \
+        proc_name, merge_script, grace, observe_only, queue_slots
+    detection_mode = mode
+    observe_only = recorder is not None
+    grace = grace_period
+    proc_name = name
+    if name != 'poller':
+        # Tell shards apart in the shared log file
+        _h.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:{}:' \
+            '%(message)s'.format(name)))
     redb = open_redis(db_params)
+    merge_script = redb.register_script(merge_lua)
+    threading.Thread(target=listen_control, daemon=True).start()
+    threading.Thread(target=ratelimit.report_rates, args=(redb, name), \
+        daemon=True).start()
     set_redis_status('running')
 
+    # Compile label extractors once
+    for lang in langs:
+        get_extractor(lang)
+
+    # Start the fetch/compare stage, one thread pool per wiki
+    edit_queue = Queue()
+    queue_slots = threading.BoundedSemaphore(queue_size)
+    executors = {'{}.{}.org'.format(lang, proj): ThreadPoolExecutor( \
+        max_workers=concurrency) for lang in langs}
+    batchers = {'https://{}.{}.org/w/api.php'.format(lang, proj): \
+        RevisionBatcher('https://{}.{}.org/w/api.php'.format(lang, proj), \
+        batch_window, batch_size, concurrency) for lang in langs}
+    dispatcher = threading.Thread(target=dispatch_edits)
+    dispatcher.start()
+
     # Start watching recent changes
     logger.info('[MAIN] Watching recent changes in {} ({})'.format(proj, \
         ', '.join(langs)))
+    set_accepted_servers(proj, langs)
     stream_url = 'https://stream.wikimedia.org/v2/stream/recentchange'
     stream_count = 0
     checked_count = 0
-    for event in EventSource(stream_url):
+    prefiltered_count = 0
+    checkpoint = Checkpoint()
+    saved_at = started = time.monotonic()
+    if events is None:
+        threading.Thread(target=watch_stream, args=(stall_timeout,), \
+            daemon=True).start()
+        events = read_stream(stream_url, stall_timeout)
+    for event in events:
         stream_count+=1
+        if recorder:
+            recorder.write_event(event)
         if event.event == 'message':
+            # Most events are dropped before being fully decoded
+            if not prefilter_event(event.data):
+                prefiltered_count += 1
+                checkpoint.read(event)
+            else:
+                try:
+                    item = json.loads(event.data) # Create dict with edit details
+                except ValueError:
+                    logger.warning('[MAIN] Unable to parse event data. Skipping')
+                    checkpoint.read(event)
+                else:
+                    # split server url to get language and project
+                    server = item['server_name'].split('.')
+                    # Filter out edits in specified project and language(s)
+                    if server[1] == proj and server[0] in langs and \
+                        item['type'] == 'edit' and item['namespace'] == 104:
+                        logger.info('[MAIN] Queueing new revision in page ' \
+                            '[{}] ({}).'.format(item['title'], server[0]))
+                        item['marker'] = checkpoint.read(event, pending=True)
+                        # Reading the stream waits while queue_size edits
+                        # are not checked yet
+                        queue_slots.acquire()
+                        item['read_at'] = time.monotonic()
+                        edit_queue.put(item)
+                        checked_count += 1
+                    else:
+                        checkpoint.read(event)
+        # Save stream position every few seconds
+        if time.monotonic() - saved_at > checkpoint_interval:
+            save_checkpoint()
+            saved_at = time.monotonic()
+        # Commands of lst_manager
+        if reload_event.is_set():
+            reload_event.clear()
+            reload_localizations(langs)
+        if stop_event.is_set():
+            logger.info('[MAIN] Stop signal received. Stopping.')
+            break
+        # Log every 10000 edits
+        if not (stream_count%10000):
+            logger.info('[MAIN] So far {} edits checked out of {} ({} ' \
+                'dropped by prefilter, {} waiting in queue)'.format( \
+                checked_count, stream_count, prefiltered_count, \
+                checked_count - latency['edits']))
+
+    # Stop signal received or no more events (replay)
+    set_redis_status('stopping')
+    stop_pipeline(dispatcher)
+    save_checkpoint()
+    elapsed = time.monotonic() - started
+    logger.info('[MAIN] In total {} edits checked out of ' \
+    ' {} ({} dropped by prefilter) in {:.1f}s ({:.1f} events/s)'.format( \
+    checked_count, stream_count, prefiltered_count, elapsed, stream_count / \
+    max(elapsed, 0.001)))
+    if latency['edits']:
+        logger.info('[MAIN] Detection latency: {:.3f}s on average, {:.3f}s ' \
+            'max'.format(latency['total'] / latency['edits'], latency['max']))
+    set_redis_status('stopped')
+    sys.exit(0)
+
+
+def read_stream(stream_url, stall_timeout):
+    """
+    Yields events from the stream. If the connection can't be opened or is
+    lost, reconnects after min_backoff seconds, doubling the wait after each
+    failed attempt (up to max_backoff).
+
+    On start, continues from the checkpoint saved in Redis: either the last
+    event id (sent as Last-Event-ID) or, if only the time is known, using the
+    since parameter of EventStreams.
+    """
+    global source
+    last_id = redb.get('{}_checkpoint_id'.format(proc_name))
+    last_id = last_id.decode('utf-8') if last_id else None
+    since = redb.get('{}_checkpoint_dt'.format(proc_name))
+    url = stream_url
+    if last_id:
+        logger.info('[READ_STREAM] Resuming stream from event {}' \
+            .format(last_id))
+    elif since:
+        url = '{}?since={}'.format(stream_url, since.decode('utf-8'))
+        logger.info('[READ_STREAM] Resuming stream from {}'.format(since \
+            .decode('utf-8')))
+    backoff = min_backoff
+    while True:
+        try:
+            source = ResumableEventSource(url, last_id=last_id, \
+                timeout=(10, stall_timeout))
+            for event in source:
+                backoff = min_backoff
+                yield event
+        except Exception as e:
+            logger.warning('[READ_STREAM] Stream connection failed ({}). ' \
+                'Reconnecting in {}s'.format(e, backoff))
+            # Continue from the last event that was received
+            if source and source.last_id:
+                last_id = source.last_id
+                url = stream_url
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+
+
+def watch_stream(stall_timeout):
+    """
+    Watchdog of the stream connection. If no event was received for
+    stall_timeout seconds, closes the connection, so EventSource reconnects.
+    Runs in a separate thread.
+    """
+    while True:
+        time.sleep(stall_timeout / 4)
+        if source and time.monotonic() - source.last_event_time > \
+            stall_timeout:
+            logger.warning('[WATCH_STREAM] No events received for {}s. ' \
+                'Reconnecting.'.format(stall_timeout))
+            source.last_event_time = time.monotonic()
             try:
-                item = json.loads(event.data) # Create dict with edit details
-            except ValueError:
-                logger.warning('[MAIN] Unable to parse event data. Skipping')
+                source.resp.close()
+            except Exception:
+                pass
+
+
+class ResumableEventSource(EventSource):
+    """
+    EventSource which remembers when the last event arrived (see
+    watch_stream()) and waits longer after every reconnect it makes itself,
+    starting at min_backoff seconds up to max_backoff.
+    """
+
+    def __init__(self, url, **kwargs):
+        self.last_event_time = time.monotonic()
+        super().__init__(url, **kwargs)
+        self.retry = min_backoff * 1000
+
+    def _connect(self):
+        # EventSource sleeps self.retry ms before each reconnect
+        self.retry = min(self.retry * 2, max_backoff * 1000)
+        super()._connect()
+        logger.info('[READ_STREAM] Connected to [{}]'.format(self.url))
+
+    def __next__(self):
+        event = super().__next__()
+        self.last_event_time = time.monotonic()
+        self.retry = min_backoff * 1000
+        return event
+
+
+def save_checkpoint():
+    """
+    Saves position of the last processed stream event in Redis: the event id
+    and its time (ISO 8601, used if the id is not accepted anymore).
+    """
+    event_id, data = checkpoint.safe_point()
+    if not event_id or observe_only:
+        return
+    mapping = {'{}_checkpoint_id'.format(proc_name): event_id}
+    timestamp = timestamp_re.search(data)
+    if timestamp:
+        mapping['{}_checkpoint_dt'.format(proc_name)] = time.strftime( \
+            '%Y-%m-%dT%H:%M:%SZ', time.gmtime(int(timestamp.group(1))))
+    redb.mset(mapping)
+
+
+class Checkpoint:
+    """
+    Keeps track of the last stream event up to which all events are
+    processed. Events that are not queued are processed once read, queued
+    edits only when run_lane() is done with them.
+
+    read() is called for every event and returns a marker for queued edits.
+    The marker is set to done when the edit is checked.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = (None, '')    # (id, data) of the last event read
+        self.pending = deque()      # markers of queued edits, in stream order
+
+    def read(self, event, pending=False):
+        with self.lock:
+            marker = None
+            if pending:
+                # Position before this event is safe until it is done
+                marker = {'safe': self.latest, 'done': False}
+                self.pending.append(marker)
+            if event.id:
+                self.latest = (event.id, event.data)
+            return marker
+
+    def safe_point(self):
+        with self.lock:
+            while self.pending and self.pending[0]['done']:
+                self.pending.popleft()
+            if self.pending:
+                return self.pending[0]['safe']
+            return self.latest
+
+
+def set_accepted_servers(proj, langs):
+    """
+    Precomputes the server names prefilter_event() lets through.
+    """
+    global accepted_servers
+    accepted_servers = set(['{}.{}.org'.format(lang, proj) for lang in langs])
+
+
+def prefilter_event(data):
+    """
+    Cheap check on the raw event data (JSON string) before decoding it.
+    Returns False if the event is surely not an edit in one of the watched
+    wikis in namespace 104, otherwise True. Events this function can't make
+    sense of are let through and handled by the full check in main().
+    """
+    server = server_name_re.search(data)
+    if server and server.group(1) not in accepted_servers:
+        return False
+    namespace = namespace_re.search(data)
+    if namespace and namespace.group(1) != '104':
+        return False
+    return True
+
+
+def dispatch_edits():
+    """
+    Second stage of the pipeline. Takes edits from the queue and hands them
+    over to the thread pool of their wiki. Stops when None is received.
+    """
+    while True:
+        item = edit_queue.get()
+        if item is None:
+            break
+        schedule_edit(item)
+
+
+def schedule_edit(item):
+    """
+    Makes sure edits of the same page are checked one at a time and in the
+    order they were received (i.e. in revision order). If an edit of the page
+    is already being checked, the new edit waits in the lane of the page,
+    otherwise a new lane is opened in the thread pool of the wiki.
+    """
+    key = (item['server_name'], item['title'])
+    # Request revision texts right away, so they are fetched in one batch
+    # with other edits, even if the edit has to wait in its lane
+    url = item['server_url'] + '/w/api.php'
+    if url in batchers and detection_mode == 'full':
+        batchers[url].submit(item['revision'])
+    with lanes_lock:
+        if key in page_lanes:
+            page_lanes[key].append(item)
+            return
+        page_lanes[key] = deque()
+    executors[item['server_name']].submit(run_lane, key, item)
+
+
+def run_lane(key, item):
+    """
+    Checks edits of a single page until its lane is empty. Runs in the thread
+    pool, see schedule_edit().
+    """
+    while item:
+        try:
+            check_edit(item)
+        except Exception as e:
+            logger.warning('[RUN_LANE] Unable to check revision {} of [{}] ' \
+                '({}). Skipping'.format(item['revision']['new'], \
+                item['title'], e))
+        if item.get('read_at'):
+            record_latency(time.monotonic() - item['read_at'])
+        if item.get('marker'):
+            item['marker']['done'] = True
+        queue_slots.release()
+        with lanes_lock:
+            if page_lanes[key]:
+                item = page_lanes[key].popleft()
             else:
-                # split server url to get language and project
-                server = item['server_name'].split('.')
-                # Filter out edits in specified project and language(s)
-                if server[1] == proj and server[0] in langs and item['type'] \
-                    == 'edit' and item['namespace'] == 104:
-                    logger.info('[MAIN] Checking new revision in page [{}] ' \
-                        '({}).'.format(item['title'], server[0]))
-                    check_edit(item)
-                    checked_count += 1
-                # Do checks every 100 edits
-                if not (stream_count%10): #TODO 100
-                    green_light = check_redis_status()
-                    if not green_light:
-                        # Means stop signal received
-                        logger.info('[MAIN] In total {} edits checked out of ' \
-                        ' {}'.format(checked_count, stream_count))
-                        logger.info('[MAIN] Stop signal received. Stopping.')
-                        set_redis_status('stopped')
-                        sys.exit(0)
-                # Log every 10000 edits
-                if not (stream_count%10000):
-                    logger.info('[MAIN] So far {} edits checked out of {}' \
-                        .format(checked_count, stream_count))
+                del page_lanes[key]
+                item = None
+
+
+def record_latency(seconds):
+    """
+    Adds the time from reading an edit from the stream until it was checked
+    to the statistics logged when the poller stops.
+    """
+    with latency_lock:
+        latency['edits'] += 1
+        latency['total'] += seconds
+        latency['max'] = max(latency['max'], seconds)
+
+
+def stop_pipeline(dispatcher):
+    """
+    Lets the dispatcher and thread pools finish all queued edits.
+    """
+    edit_queue.put(None)
+    dispatcher.join()
+    # Lanes may still be running, wait until all of them are done
+    for executor in executors.values():
+        executor.shutdown(wait=True)
+    logger.info('[STOP_PIPELINE] All queued edits checked.')
 
 
 def open_redis(db_params):
@@ -97,43 +479,57 @@ def open_redis(db_params):
 
 
 def set_redis_status(status):
-    lock_redis()
-    redb.set('{}_status'.format(proc_name), status)
-    lock_redis(unlock=True)
+    """
+    Saves status of the process (shown by lst_manager -status) and announces
+    it on channel lstg:ack, in one round trip.
+    """
+    pipe = redb.pipeline()
+    pipe.set('{}_status'.format(proc_name), status)
+    pipe.publish('lstg:ack', '{} {}'.format(proc_name, status))
+    pipe.execute()
     logger.info('[SET REDIS STATUS] Set status to {}'.format(status.upper()))
 
 
-def check_redis_status():
-    status = redb.get('{}_status'.format(proc_name)).decode('utf-8')
-    return False if status == 'stopping' else True
+def listen_control():
+    """
+    Receives commands of lst_manager from Redis channel lstg:control. A
+    command is either '<command>' (for all processes) or '<command> <name>'.
+    Supported commands:
+        stop    - finish queued edits and exit
+        reload  - reload localizations.py
+    Runs in a separate thread, main() reacts on stop_event and reload_event.
+    """
+    pubsub = redb.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe('lstg:control')
+    for message in pubsub.listen():
+        command = message['data'].decode('utf-8').split()
+        if not command or (len(command) > 1 and command[1] != proc_name):
+            continue
+        logger.info('[LISTEN CONTROL] Received command [{}]'.format( \
+            command[0]))
+        if command[0] == 'stop':
+            stop_event.set()
+        elif command[0] == 'reload':
+            reload_event.set()
 
 
-def lock_redis(unlock=False):
-    if unlock:
-        redb.set('locked', 0)
-    else:
-        # Check if locked is set
-        if not redb.get('locked'):
-            redb.set('locked', 0 if unlock else 1)
-        elif int(redb.get('locked')):
-            logger.info('[LOCK_REDIS] Waiting 10s for Redb to unlock')
-            waited = 0
-            while (int(redb.get('locked'))):
-                sleep(0.01)
-                waited += 1
-                if waited > 10000: # we waited 100s
-                    logger.warning('[LOCK_REDIS] Unable to lock Redb. ' \
-                    'Terminating.')
-                    sys.exit(1)
-            logger.info('[LOCK_REDIS] Unlocked after {}s'.format(waited/100))
-        redb.set('locked', 1)
+def reload_localizations(langs):
+    """
+    Reloads label syntax from localizations.py and recompiles extractors.
+    """
+    global section_label, extractors
+    importlib.reload(localizations)
+    section_label = localizations.section_label
+    extractors = {lang: LabelExtractor(lang) for lang in langs}
+    redb.publish('lstg:ack', '{} reloaded'.format(proc_name))
+    logger.info('[RELOAD LOCALIZATIONS] Reloaded localizations.')
 
 
 def check_edit(item):
     """
     Parses the required parameters and psses data over to check_revision() which
-    does the actual checking. If changed labels are detected calls write_data()
-    to save edit data in Redis.
+    does the actual checking (or check_revision_diff() in diff mode). If changed
+    labels are detected calls write_data() to save edit data in Redis.
 
     Argument:
     item (dict) - should contain the following:
@@ -148,7 +544,10 @@ def check_edit(item):
     lang = item['server_name'].split('.')[0]
 
     # See if there are changed labels in revision (returns a dict)
-    changed_labels = check_revision(revids, url, lang)
+    if detection_mode == 'diff':
+        changed_labels = check_revision_diff(revids, url, lang)
+    else:
+        changed_labels = check_revision(revids, url, lang)
 
     # If there are any changed labels, write data to Redis
     if changed_labels:
@@ -158,7 +557,9 @@ def check_edit(item):
                     'lang': lang,
                     'url': url,
                     'labels': changed_labels }
-        write_data(data)
+        # A recording must not queue pages for the workers
+        if not observe_only:
+            write_data(data)
 
 
 def check_revision(revids, url, lang):
@@ -191,49 +592,248 @@ def check_revision(revids, url, lang):
     return changed_labels
 
 
+def check_revision_diff(revids, url, lang):
+    """
+    Same as check_revision(), but first gets only the diff of the revision
+    (see get_compare()) and looks for labels in changed lines. If labels were
+    only renamed in place, changed labels are taken from the diff. Full texts
+    are compared only if labels were added, removed or moved to other lines,
+    or the diff is not available.
+
+    Returns:
+        Dict with modified labels: old label as key, new label as value.
+    """
+    rows = get_compare(revids, url)
+    if rows is None:
+        return check_revision(revids, url, lang)
+
+    changed_labels = {}
+    extractor = get_extractor(lang)
+    for deleted, added in rows:
+        old_labels = [l for l, pos in extractor.extract(deleted or '')]
+        new_labels = [l for l, pos in extractor.extract(added or '')]
+        if not old_labels and not new_labels:
+            continue
+        # Labels appear or disappear in this line, pairs can't be found in diff
+        if len(old_labels) != len(new_labels):
+            return check_revision(revids, url, lang)
+        for old, new in zip(old_labels, new_labels):
+            if old != new:
+                changed_labels[old] = new
+    return changed_labels
+
+
+def get_compare(revids, url):
+    """
+    Gets the diff between two revisions (action=compare).
+
+    Arguments:
+        revids  - Dict with revision ids (two items: 'old' and 'new', both int)
+        url     - API reference point
+
+    Returns: List of tuples (deleted line, added line), one for each changed
+    line. Either can be None for lines that were only added or deleted.
+    None if the diff is not available.
+    """
+    try:
+        resp = ratelimit.get(url, params = {
+                            'action': 'compare',
+                            'fromrev': revids['old'],
+                            'torev': revids['new'],
+                            'format': 'json',
+                            'utf8': ''
+                            })
+        js = json.loads(resp.content.decode('utf-8'))
+        table = js['compare']['*']
+    except Exception as e:
+        logger.warning('[GET_COMPARE] Unable to get diff of revision {} from ' \
+            '[{}] ({})'.format(revids['new'], url, e))
+        return None
+
+    rows = []
+    for row in diff_row_re.findall(table):
+        cells = {'deletedline': None, 'addedline': None}
+        for side, content in diff_cell_re.findall(row):
+            # Strip highlighting of changes and decode entities
+            cells[side] = html.unescape(html_tag_re.sub('', content))
+        if cells['deletedline'] is not None or cells['addedline'] is not None:
+            rows.append((cells['deletedline'], cells['addedline']))
+    return rows
+
+
 def get_diff(revids, url):
     """
     Gets the page content before and after the revision (in wikisyntax).
 
+    If the poller is running, the request is collected by the RevisionBatcher
+    of the wiki and fetched together with revisions of other edits.
+
     Arguments:
         revids  - Dict with revision ids (two items: 'old' and 'new', both int)
         url     - API reference point
 
-    Returns: Tuple of two strings
+    Returns: Tuple of two strings (both None if revisions are not available)
+
+    """
+    if url in batchers:
+        return batchers[url].get(revids)
+    texts, bad_revids = get_revisions(url, [revids['old'], revids['new']])
+    return match_revisions(revids, texts, bad_revids)
+
+
+def get_revisions(url, revids):
+    """
+    Gets the content of several revisions with a single API request
+    (continued if the response is too large).
+
+    Arguments:
+        url     - API reference point
+        revids  - List of revision ids (max 50)
 
+    Returns: Tuple of:
+        dict    - revision id as key, tuple (page id, content) as value
+        set     - revision ids the API reported as bad
     """
-    # TODO Exception handling
-    resp = (requests.get(url, params = {
-                        'action': 'query',
-                        'prop': 'revisions',
-                        'rvprop': 'content',
-                        'format': 'json',
-                        'utf8': '',
-                        'revids': str(revids['old']) + '|' + str(revids['new'])
-                        }))
-    if resp.status_code != 200: # Means something went wrong.
-        raise ApiError('GET /tasks/ {}'.format(resp.status_code))
+    params = {  'action': 'query',
+                'prop': 'revisions',
+                'rvprop': 'ids|content',
+                'format': 'json',
+                'utf8': '',
+                'revids': '|'.join([str(r) for r in sorted(set(revids))])
+                }
+    texts = {}
+    bad_revids = set()
+    while True:
+        resp = ratelimit.get(url, params = params)
+        if resp.status_code != 200: # Means something went wrong.
+            raise ApiError('GET {} {}'.format(url, resp.status_code))
+
+        # Decode to make sure non-latin characters are displayed correctly
+        js = json.loads(resp.content.decode('utf-8'))
+
+        # Wrong revision IDs are listed separately
+        for revid in js['query'].get('badrevids', {}).keys():
+            bad_revids.add(int(revid))
 
-    # Decode to make sure non-latin characters are displayed correctly
-    js = json.loads(resp.content.decode('utf-8'))
+        for pageid, page in js['query'].get('pages', {}).items():
+            for rev in page.get('revisions', []):
+                if '*' in rev:
+                    texts[rev['revid']] = (pageid, rev['*'])
+
+        # Large responses are split, request the rest
+        if 'continue' not in js:
+            break
+        params.update(js['continue'])
+    return texts, bad_revids
+
+
+def match_revisions(revids, texts, bad_revids):
+    """
+    Picks the old and new revision of a single edit from the output of
+    get_revisions().
 
+    Returns: Tuple of two strings (both None if revisions are not available)
+    """
     # Check for error (if true, means wrong revision IDs were sent)
-    if ('badrevids' in js['query'].keys()):
+    if revids['old'] in bad_revids or revids['new'] in bad_revids:
+        return None, None
+    if revids['old'] not in texts or revids['new'] not in texts:
         return None, None
 
-    # Find page id(s) in json, shouldn't be more than 1
-    pageid = list(js['query']['pages'].keys())
+    old_pageid, old_text = texts[revids['old']]
+    new_pageid, new_text = texts[revids['new']]
 
     # Check for error (Revision IDs from different pages)
-    # TODO: WTH is this?
-    if not (len(pageid) == 1):
+    if old_pageid != new_pageid:
         return None, None
 
     # Else everything is ok
-    pageid = pageid[0]
-    diffs = js['query']['pages'][pageid]['revisions']
+    return old_text, new_text
+
+
+class ApiError(Exception):
+    pass
+
+
+class RevisionBatcher:
+    """
+    Collects revision requests of edits in one wiki and fetches them in a
+    single API request. A batch is sent when window seconds have passed since
+    the first request came in, or when it holds max_revids revisions.
+    At most concurrency batches are fetched at the same time.
+
+    submit() only registers the request and returns a Future, get() waits for
+    the result.
+    """
 
-    return diffs[0]['*'], diffs[1]['*']
+    def __init__(self, url, window, max_revids, concurrency):
+        self.url = url
+        self.window = window
+        self.max_revids = max_revids
+        self.pending = []   # requests not sent yet: list of (key, Future)
+        self.futures = {}   # all requests not taken yet: key -> Future
+        self.cond = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, revids):
+        key = (revids['old'], revids['new'])
+        with self.cond:
+            if key not in self.futures:
+                self.futures[key] = Future()
+                self.pending.append((key, self.futures[key]))
+                self.cond.notify()
+            return self.futures[key]
+
+    def get(self, revids):
+        future = self.submit(revids)
+        try:
+            return future.result()
+        finally:
+            with self.cond:
+                self.futures.pop((revids['old'], revids['new']), None)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                # Wait for more requests until window is over or batch is full
+                deadline = time.monotonic() + self.window
+                while self.count_revids(self.pending) < self.max_revids:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self.take_batch()
+            self.pool.submit(self.fetch, batch)
+
+    def count_revids(self, batch):
+        return len(set([r for key, future in batch for r in key]))
+
+    def take_batch(self):
+        batch = []
+        while self.pending and self.count_revids(batch + \
+            self.pending[:1]) <= self.max_revids:
+            batch.append(self.pending.pop(0))
+        # Never send an empty batch (only possible with max_revids < 2)
+        if not batch:
+            batch.append(self.pending.pop(0))
+        return batch
+
+    def fetch(self, batch):
+        revids = [r for key, future in batch for r in key]
+        try:
+            texts, bad_revids = get_revisions(self.url, revids)
+        except Exception as e:
+            logger.warning('[REVISION_BATCHER] Unable to get {} revisions ' \
+                'from [{}] ({})'.format(len(set(revids)), self.url, e))
+            for key, future in batch:
+                future.set_exception(e)
+        else:
+            for key, future in batch:
+                future.set_result(match_revisions({'old': key[0], \
+                    'new': key[1]}, texts, bad_revids))
 
 
 def extract_labels(wikitext, lang):
@@ -241,74 +841,196 @@ def extract_labels(wikitext, lang):
     Retrieve section labels from a wiki-page. The label syntax is obtained
     from the localizations file. Checks for both, localized and English syntax.
     """
-    labels = []
-    en_label = section_label['en']  # English syntax
-    loc_label = section_label[lang] # Localized syntax
-
-    for line in wikitext.splitlines():
-        # Check localized syntax of labels
-        if loc_label and loc_label in line:
-            # Some regex to deal with irregularietes (brackets, whitespace)
-            label = re.search(r'<{}\s?=\s?"?(.*?)"?\s?/>'.format(loc_label), line)
-            if label:
-                labels.append(label.groups()[0])
-        # Check English syntax of labels (since most wikis use English syntax)
-        elif en_label in line: # TODO was initialy if, doublecheck
-            label = re.search(r'<{}\s?=\s?"?(.*?)"?\s?/>'.format(en_label), line)
-            if label:
-                labels.append(label.groups()[0])
-    return labels
+    return [label for label, pos in get_extractor(lang).extract(wikitext)]
+
+
+def get_extractor(lang):
+    """
+    Returns the LabelExtractor of the language. Extractors of watched
+    languages are compiled when the poller starts, others on first use.
+    """
+    if lang not in extractors:
+        extractors[lang] = LabelExtractor(lang)
+    return extractors[lang]
+
+
+class LabelExtractor:
+    """
+    Finds section labels in wikitext with a single precompiled regex, in one
+    pass over the whole text. Both localized and English syntax are matched,
+    with some irregularities (whitespace, quotes), eg.:
+
+        <section begin="Some label" />
+        <section begin = s1/>
+        <Abschnitt Anfang='Some label'/>
+    """
+
+    def __init__(self, lang):
+        names = [section_label['en']]   # English syntax
+        if section_label.get(lang) and section_label[lang] not in names:
+            names.append(section_label[lang])   # Localized syntax
+        # Any whitespace is allowed between words of the tag
+        tags = '|'.join([r'\s+'.join([re.escape(word) for word in \
+            name.split()]) for name in names])
+        self.regex = re.compile(r'<\s*(?:' + tags + r')\s*=\s*'
+            r'(?:"([^"<>\n]*)"'         # "label"
+            r"|'([^'<>\n]*)'"           # 'label'
+            '|([^"\'<>\\n]*?))\\s*/>')  # label
+
+    def extract(self, wikitext):
+        """
+        Returns list of tuples (label, position in wikitext), in the order
+        labels appear in the text.
+        """
+        labels = []
+        for match in self.regex.finditer(wikitext):
+            double, single, bare = match.groups()
+            label = double if double is not None else single if single is \
+                not None else bare
+            labels.append((label, match.start()))
+        return labels
 
 
 def write_data(new_item):
     """
-    Writes new edit details into Redis. If Redis contains old data, new item is
-    merged into it. Matching label names in old and new data are handled
-    distinctly (see comments below).
-    """
-
-    lock_redis()
-    # If Redis is not empty, first load older data
-    all_data = []
-    if not redb.get('empty'): # Make sure 'empty' variable exists
-        redb.set('empty', 1)
-    elif not int(redb.get('empty')): # Means not empty
-        # We get a list of saved edits each as a dict. See also check_edit().
-        all_data = json.loads(redb.get('lstdata').decode('utf-8'))
-
-    # Merge new data into old data. For identical lables do further checks
-    if len(all_data) > 0:
-        for old_item in all_data:
-            # Look for identical labels in new and old item
-            # oldl, newl = old and new labels in old item
-            for oldl, newl in zip(list(old_item['labels'].keys()),
-                list(old_item['labels'].values())):
-                if newl in new_item['labels'].keys():
-                    # Means same label is changed twice
-                    if oldl == new_item['labels'][newl]:
-                    # Case 1: label changed back (reverted), eg. a->b, b->a.
-                    # We remove old label pair, but keep the new one (b->a)
-                    # Because it mights still happen that transclusions are
-                    # manually updated to b and we need to revert it back to a.
-                        old_item['labels'].pop(oldl)
-                    else:
-                    # Case 2: label changed to something else, eg. a->b, b->c.
-                    # We update old label pair so that a->b becomes a->c.
-                    # So every transclusion with a or b will be updated to c.
-                        old_item['labels'][oldl] = new_item['labels'][newl]
-            # If no more label pairs remove old item
-            if len(old_item['labels']) == 0:
-                all_data.pop(all_data.index(old_item))
-    # Finally merge the two lists
-    all_data.append(new_item)
-
-    # Write merged data into Redis
-    redb.set('lstdata', json.dumps(all_data))
-    redb.set('empty', 0)
-    lock_redis(unlock=True)
+    Writes new edit details into Redis. Changed labels are stored per page:
+
+        lstdata:labels:<wiki>|<title>   - hash, any former label -> current
+                                          label (the alias map)
+        lstdata:origins:<wiki>|<title>  - hash, current label -> JSON list of
+                                          former labels that map to it
+        lstdata:info:<wiki>|<title>     - hash with title, lang, url and
+                                          version (number of merged edits)
+        lstdata:pages                   - set of pages with pending changes
+        lstdata:schedule                - sorted set of pending pages, scored
+                                          by due time (time of the last change
+                                          + grace period), workers move due
+                                          pages to their stream (see
+                                          lst_worker.main())
+
+    New labels are merged into the alias map of the page, so every former
+    label resolves straight to its current name, however long the chain of
+    renames (eg. a->b, b->c gives a->c, b->c) and reverted labels drop out
+    (see comments in merge_lua). The merge runs as a Lua script inside Redis,
+    so it is atomic and takes a single round trip.
+    """
+    key = page_key(new_item)
+    args = [key, new_item['title'], new_item['lang'], new_item['url'], \
+        time.time() + grace]
+    for oldl, newl in new_item['labels'].items():
+        args.extend([oldl, newl])
+    merge_script(keys=['lstdata:labels:{}'.format(key), \
+        'lstdata:info:{}'.format(key), 'lstdata:origins:{}'.format(key), \
+        'lstdata:pages', 'lstdata:schedule'], args=args)
     logger.info('[WRITE_DATA] Saved data in Redb')
 
 
+def page_key(item):
+    """
+    Key of the page in Redis: '<wiki>|<title>', eg. 'en.wikisource.org|Page:A'
+    """
+    return '{}|{}'.format(item['url'].split('/')[2], item['title'])
+
+
+# Merges new labels of a page into its alias map, see write_data().
+# Labels renamed in one edit are renamed at once (so a->b, b->c in the same
+# edit is a shift, not a chain). Each rename only touches the labels that
+# currently map to the old label.
+# KEYS: labels hash, info hash, origins hash, pages set, schedule
+# ARGV: page key, title, lang, url, due time, followed by pairs of old and new
+#       label
+merge_lua = """
+-- Collect each renamed label with its former labels before changing anything.
+-- A former label which is also renamed in this edit goes with its own group
+-- (its latest meaning wins).
+local renamed = {}
+for i = 6, #ARGV, 2 do
+    renamed[ARGV[i]] = true
+end
+-- A new label which is not renamed itself in this edit is a current label
+-- now, not a former one, eg. a->b, then c->a: transclusions with a are not
+-- updated to b anymore.
+for i = 6, #ARGV, 2 do
+    local new = ARGV[i + 1]
+    local current = not renamed[new] and redis.call('HGET', KEYS[1], new)
+    if current then
+        redis.call('HDEL', KEYS[1], new)
+        local kept = {}
+        local former = redis.call('HGET', KEYS[3], current) or '[]'
+        for _, label in ipairs(cjson.decode(former)) do
+            if label ~= new then
+                table.insert(kept, label)
+            end
+        end
+        if #kept > 0 then
+            redis.call('HSET', KEYS[3], current, cjson.encode(kept))
+        else
+            redis.call('HDEL', KEYS[3], current)
+        end
+    end
+end
+local groups = {}
+for i = 6, #ARGV, 2 do
+    local group = {ARGV[i]}
+    local former = redis.call('HGET', KEYS[3], ARGV[i])
+    if former then
+        for _, label in ipairs(cjson.decode(former)) do
+            if not renamed[label] then
+                table.insert(group, label)
+            end
+        end
+    end
+    table.insert(groups, {group, ARGV[i + 1]})
+end
+for i = 6, #ARGV, 2 do
+    redis.call('HDEL', KEYS[3], ARGV[i])
+end
+for _, pair in ipairs(groups) do
+    local group, new = pair[1], pair[2]
+    local origins, seen = {}, {}
+    local former = redis.call('HGET', KEYS[3], new)
+    if former then
+        origins = cjson.decode(former)
+        for _, label in ipairs(origins) do
+            seen[label] = true
+        end
+    end
+    for _, label in ipairs(group) do
+        if label == new then
+            -- Label changed back (reverted), eg. a->b, b->a: a is current
+            -- again, we keep only b->a. Because it mights still happen that
+            -- transclusions are manually updated to b.
+            redis.call('HDEL', KEYS[1], label)
+        else
+            -- Label changed (maybe again), eg. a->b, b->c: every
+            -- transclusion with a or b will be updated to c.
+            redis.call('HSET', KEYS[1], label, new)
+            if not seen[label] then
+                seen[label] = true
+                table.insert(origins, label)
+            end
+        end
+    end
+    if #origins > 0 then
+        redis.call('HSET', KEYS[3], new, cjson.encode(origins))
+    else
+        redis.call('HDEL', KEYS[3], new)
+    end
+end
+redis.call('HMSET', KEYS[2], 'title', ARGV[2], 'lang', ARGV[3], 'url', ARGV[4])
+redis.call('HINCRBY', KEYS[2], 'version', 1)
+-- Resolved pages expire (see lst_worker.ack_page()), not while pending
+redis.call('PERSIST', KEYS[1])
+redis.call('PERSIST', KEYS[2])
+redis.call('PERSIST', KEYS[3])
+-- Schedule the page for workers, each change postpones it
+redis.call('ZADD', KEYS[5], ARGV[5], ARGV[1])
+if redis.call('SADD', KEYS[4], ARGV[1]) == 1 then
+    redis.call('PUBLISH', 'lstg:wake', ARGV[1])
+end
+"""
+
+
 if __name__ == '__main__':
     p,l,host,port,id = sys.argv[1:]
     main(p,l,(host,port,id))
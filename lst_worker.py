@@ -1,20 +1,51 @@
 # !/usr/local/bin/python3
 # -*- coding: utf-8 -*-
 
+import importlib
 import json
 import requests
 import time
 import redis
 import re
 import logging
+import socket
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from configparser import ConfigParser
+import localizations
+import ratelimit
 from localizations import template, edit_summary
 
-global proc_name, stop_button, user, pssw, redb, debug_mode, debug_fp
+global proc_name, user, pssw, redb, debug_mode, debug_fp, \
+    consumer, ack_script, promote_script, unlock_script, aliases_ttl, template, edit_summary, \
+    fetch_concurrency, edit_concurrency, content_batch, transclusion_ns, \
+    status_ttl, parsers, content_cache, retry_delay
 debug_fp = 'debug_edits.html'
 proc_name = 'worker'
-stop_button = True  # While true bot will not edit any pages
+group = 'workers'   # Consumer group of all workers on lstdata:stream
+stop_event = threading.Event()      # Set by listen_control()
+reload_event = threading.Event()    # Set by listen_control()
+wake_event = threading.Event()      # Set when new pages are scheduled
+executors = {}      # Per wiki thread pools checking transclusions
+edit_limits = {}    # Per wiki semaphores limiting parallel edits
+fetch_concurrency = 4
+edit_concurrency = 1
+content_batch = 50  # Pages per content request (API limit, 500 for bots)
+transclusion_ns = '0'   # Namespaces of transcluding pages to check
+sessions = {}       # Per wiki sessions of the bot, see get_session()
+sessions_lock = threading.Lock()
+wiki_states = {}    # Per wiki stop button and status, see check_stopbutton()
+status_lock = threading.Lock()
+status_ttl = 60     # Seconds to trust wiki_states
+parsers = {}        # TransclusionParser per language
+content_cache = None    # ContentCache of transcluding pages, set by main()
+recovering = True   # Own pending entries not read yet, see read_pages()
+max_conflicts = 3   # Edit conflicts before giving up a page, see check_target()
+lock_ttl = 120      # Seconds a transcluding page stays locked, see page_lock()
+retry_delay = 300   # Seconds before a page that failed is due again
 
 logger = logging.getLogger('worker')
 _h = logging.FileHandler('logs/worker.log')
@@ -23,23 +54,54 @@ logger.addHandler(_h)
 logger.setLevel(logging.INFO)
 logger.propagate = False
 
-#TODO extend sleaping time to avoid edit conflict
-
-def main(db_params, debug=False, username=None, password=None):
+def main(db_params, debug=False, username=None, password=None, name='worker',
+    claim_idle=900, resolved_ttl=86400, concurrency=4, edit_limit=1,
+    batch_size=50, namespaces=('0',), status_cache=60, cache_size=64,
+    cache_spill=False, cache_ttl=3600, retry=300):
     """
     Main Routine.
-    Wakes up every 5 minutes to read new data from Redis. If there is new data,
-    will call check_saved_data() otherwise will sleep again.
+    Pages with changed labels are scheduled by the poller in lstdata:schedule,
+    due a grace period after their last change (editors might fix the
+    transclusions by hand meanwhile). Due pages are moved to the Redis stream
+    lstdata:stream (see promote_due()), which is read as a member of the
+    consumer group 'workers' (several workers can run at the same time), and
+    check_saved_data() is called for each of them. When there are no pages,
+    sleeps until the next page is due, the poller announces a new one
+    (channel lstg:wake) or claim_idle seconds pass.
 
-    The variables read from Redis:
-    locked - means others are editing data
-    empty - means no data
-    lstdata - the data, list with dicts
+    Listens to commands of lst_manager in a separate thread (see
+    listen_control()). If stop signal is received will exit.
 
-    empty and locked are strings, since Redis has no boolean types.
+    Optional arguments:
+    - name (string)         - name of the process, used for its keys in Redis
+                              and as consumer name in the group
+    - claim_idle (int)      - seconds after which pages taken by another
+                              worker, but not finished, are taken over
+    - resolved_ttl (int)    - seconds to keep label aliases of a checked page
+    - concurrency (int)     - maximum number of transclusions checked in
+                              parallel in each wiki (see check_saved_data())
+    - edit_limit (int)      - maximum number of parallel edits in each wiki
+    - batch_size (int)      - maximum number of pages in one content request
+                              (see get_pagecontents())
+    - namespaces (list)     - namespaces of transcluding pages to check
+    - status_cache (int)    - seconds to trust the last read of the stop
+                              button (see check_stopbutton())
+    - cache_size (int)      - megabytes of page contents kept in memory
+                              (0 disables the cache, see ContentCache)
+    - cache_spill (bool)    - keep pages dropped from memory in Redis
+    - cache_ttl (int)       - seconds to keep pages in Redis
+    - retry (int)           - seconds before a page is checked again if its
+                              transclusions could not be checked (see
+                              retry_page())
+
+    The variables read from Redis:
+    lstdata:schedule    - pages with changed labels by due time
+    lstdata:stream      - due pages with changed labels (see read_pages())
     """
     # Check if we run in dubug mode
-    global debug_mode, user, pssw
+    global debug_mode, user, pssw, proc_name, consumer, aliases_ttl, \
+        fetch_concurrency, edit_concurrency, content_batch, transclusion_ns, \
+        status_ttl, content_cache, retry_delay
     if debug:
         debug_mode = True
         user = None
@@ -48,40 +110,66 @@ def main(db_params, debug=False, username=None, password=None):
         debug_mode = False
         user = username
         pssw = password
+    proc_name = name
+    aliases_ttl = resolved_ttl
+    fetch_concurrency = concurrency
+    edit_concurrency = edit_limit
+    content_batch = batch_size
+    transclusion_ns = '|'.join(namespaces)
+    status_ttl = status_cache
+    retry_delay = retry
+    if cache_size:
+        content_cache = ContentCache(cache_size * 1024 * 1024, cache_spill, \
+            cache_ttl)
+    consumer = '{}@{}'.format(name, socket.gethostname())
+    if name != 'worker':
+        # Tell workers apart in the shared log file
+        _h.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:{}:' \
+            '%(message)s'.format(name)))
     # Open Redis
-    global redb
+    global redb, ack_script, promote_script, unlock_script
     redb = open_redis(db_params)
-    set_redis_status('running')
+    ack_script = redb.register_script(ack_lua)
+    unlock_script = redb.register_script(unlock_lua)
+    promote_script = redb.register_script(promote_lua)
+    create_group()
+    threading.Thread(target=listen_control, daemon=True).start()
+    threading.Thread(target=ratelimit.report_rates, args=(redb, name), \
+        daemon=True).start()
+    set_redis_status('running debug mode' if debug_mode else 'running')
 
     logger.info('[MAIN] Starting worker in {} mode'.format('DEBUG' if \
         debug_mode else 'NORMAL'))
 
-    while True:
+    while not stop_event.is_set():
+        if reload_event.is_set():
+            reload_event.clear()
+            reload_localizations()
         # See if there is new data:
-        if not redb.get('empty'):
-            # Make sure 'empty' is set in Redis
-            lock_redis()
-            redb.set('empty', 1)
-            lock_redis(unlock=True)
-        elif not int(redb.get('empty')):
-            # Means not empty, so continue
-            data = json.loads(redb.get('lstdata').decode('utf-8'))
-            lock_redis()
-            redb.delete('lstdata')
-            redb.set('empty', 1)
-            lock_redis(unlock=True)
-            logger.info('[MAIN] Loaded new data from Redis DB. Checking labels.')
-            check_saved_data(data)
-        # Sleep 5 minutes and in between check redis status
-        for i in range(10): #TODO set 100
-            time.sleep(3)
-            green_light = check_redis_status()
-            if not green_light:
-                # Means stop signal received
-                logger.info('[MAIN] Stop signal received. Stopping.')
-                # TODO before exiting check redis data again?
-                set_redis_status('stopped')
-                sys.exit(0)
+        wake_event.clear()
+        next_due = promote_due()
+        entries = read_pages(claim_idle)
+        pages = [page for entry_id, page in entries if page]
+        failed = set()
+        if pages:
+            logger.info('[MAIN] Loaded new data from Redis DB. Checking ' \
+                'labels.')
+            failed = check_saved_data(pages)
+        for entry_id, page in entries:
+            if page and page['key'] in failed:
+                retry_page(entry_id, page)
+            else:
+                ack_page(entry_id, page)
+        if not entries:
+            # Sleep until the next page is due
+            timeout = claim_idle
+            if next_due is not None:
+                timeout = min(claim_idle, max(0, next_due - time.time()))
+            wake_event.wait(timeout)
+    # Means stop signal received
+    logger.info('[MAIN] Stop signal received. Stopping.')
+    set_redis_status('stopped')
+    sys.exit(0)
 
 
 def open_redis(db_params):
@@ -100,36 +188,222 @@ def open_redis(db_params):
 
 
 def set_redis_status(status):
-    lock_redis()
-    redb.set('{}_status'.format(proc_name), status)
-    lock_redis(unlock=True)
+    """
+    Saves status of the process (shown by lst_manager -status) and announces
+    it on channel lstg:ack, in one round trip.
+    """
+    pipe = redb.pipeline()
+    pipe.set('{}_status'.format(proc_name), status)
+    pipe.publish('lstg:ack', '{} {}'.format(proc_name, status))
+    pipe.execute()
     logger.info('[SET REDIS STATUS] Set status to {}'.format(status.upper()))
 
 
-def check_redis_status():
-    status = redb.get('{}_status'.format(proc_name)).decode('utf-8')
-    return False if status == 'stopping' else True
+def listen_control():
+    """
+    Receives commands of lst_manager from Redis channel lstg:control. A
+    command is either '<command>' (for all processes) or '<command> <name>'.
+    Supported commands:
+        stop    - finish the current page and exit
+        reload  - reload localizations.py
+    Also wakes up main() when pages are queued (channel lstg:wake).
+    Runs in a separate thread.
+    """
+    pubsub = redb.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe('lstg:control', 'lstg:wake')
+    for message in pubsub.listen():
+        if message['channel'] == b'lstg:wake':
+            wake_event.set()
+            continue
+        command = message['data'].decode('utf-8').split()
+        if not command or (len(command) > 1 and command[1] != proc_name):
+            continue
+        logger.info('[LISTEN CONTROL] Received command [{}]'.format( \
+            command[0]))
+        if command[0] == 'stop':
+            stop_event.set()
+            set_redis_status('stopping')
+        elif command[0] == 'reload':
+            reload_event.set()
+        wake_event.set()
 
 
-def lock_redis(unlock=False):
-    if unlock:
-        redb.set('locked', 0)
-    else:
-        # Check if locked is set
-        if not redb.get('locked'):
-            redb.set('locked', 0 if unlock else 1)
-        elif int(redb.get('locked')):
-            logger.info('[LOCK_REDIS] Waiting 10s for Redb to unlock')
-            waited = 0
-            while (int(redb.get('locked'))):
-                sleep(0.01)
-                waited += 1
-                if waited > 10000: # we waited 100s
-                    logger.warning('[LOCK_REDIS] Unable to lock Redb. ' \
-                    'Terminating.')
-                    sys.exit(1)
-            logger.info('[LOCK_REDIS] Unlocked after {}s'.format(waited/100))
-        redb.set('locked', 1)
+def reload_localizations():
+    """
+    Reloads templates and edit summaries from localizations.py.
+    """
+    global template, edit_summary, parsers
+    importlib.reload(localizations)
+    template = localizations.template
+    edit_summary = localizations.edit_summary
+    parsers = {}
+    redb.publish('lstg:ack', '{} reloaded'.format(proc_name))
+    logger.info('[RELOAD LOCALIZATIONS] Reloaded localizations.')
+
+
+def create_group():
+    """
+    Creates the consumer group of workers, unless it already exists.
+    """
+    try:
+        redb.xgroup_create('lstdata:stream', group, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def promote_due():
+    """
+    Moves pages that are due from lstdata:schedule to lstdata:stream (in one
+    atomic step, so with several workers each page is moved once). Returns
+    due time of the next scheduled page, or None if none is scheduled.
+    """
+    next_due = promote_script(keys=['lstdata:schedule', 'lstdata:stream'], \
+        args=[time.time()])
+    return float(next_due) if next_due is not None else None
+
+
+# Moves due pages to the stream, see promote_due().
+# KEYS: schedule, stream
+# ARGV: current time
+promote_lua = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, key in ipairs(due) do
+    redis.call('XADD', KEYS[2], '*', 'page', key)
+end
+if #due > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+end
+local next = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return next[2]
+"""
+
+
+def read_pages(claim_idle, count=10):
+    """
+    Returns list of tuples (entry id, page) of pages to check. Entries this
+    worker took before it was restarted are read again first, then entries
+    that any worker took but didn't acknowledge for claim_idle seconds (eg.
+    because it crashed) are taken over. Doesn't wait for new entries.
+
+    Page is a dict as expected by check_saved_data() (None if the page has no
+    pending changes anymore). See lst_poller.write_data() for the layout of
+    data in Redis.
+    """
+    global recovering
+    entries = []
+    if recovering:
+        # Own unacknowledged entries, id 0 reads them instead of new ones
+        for stream, stream_entries in redb.xreadgroup(group, consumer, \
+            {'lstdata:stream': '0'}, count=count):
+            entries.extend(stream_entries)
+        if entries:
+            logger.info('[READ PAGES] Resuming {} unfinished page(s).' \
+                .format(len(entries)))
+        else:
+            recovering = False
+    if not entries:
+        stale = find_stale(claim_idle, count)
+        if stale:
+            entries = redb.xclaim('lstdata:stream', group, consumer, \
+                claim_idle * 1000, stale)
+            logger.info('[READ PAGES] Took over {} unfinished page(s).' \
+                .format(len(entries)))
+    if not entries:
+        for stream, stream_entries in redb.xreadgroup(group, consumer, \
+            {'lstdata:stream': '>'}, count=count):
+            entries.extend(stream_entries)
+    # Entries deleted from the stream have no fields, they are just acked
+    return [(entry_id, load_page(fields[b'page'].decode('utf-8')) if fields \
+        else None) for entry_id, fields in entries]
+
+
+def find_stale(claim_idle, count):
+    """
+    Returns ids of at most count entries that were not acknowledged for
+    claim_idle seconds. The whole pending list is searched, a page of 100
+    entries at a time.
+    """
+    stale = []
+    start = '-'
+    while len(stale) < count:
+        pending = redb.xpending_range('lstdata:stream', group, start, '+', 100)
+        stale.extend([p['message_id'] for p in pending if \
+            p['time_since_delivered'] > claim_idle * 1000])
+        if len(pending) < 100:
+            break
+        # Next page starts right after the last entry
+        ms, seq = pending[-1]['message_id'].decode('utf-8').split('-')
+        start = '{}-{}'.format(ms, int(seq) + 1)
+    return stale[:count]
+
+
+def load_page(key):
+    """
+    Reads pending changes of a single page. Returns dict with title, lang,
+    url, labels and version (number of merged edits), or None if there are
+    no pending changes (eg. the page was already checked by an earlier
+    entry).
+    """
+    pipe = redb.pipeline()
+    pipe.sismember('lstdata:pages', key)
+    pipe.hgetall('lstdata:info:{}'.format(key))
+    pipe.hgetall('lstdata:labels:{}'.format(key))
+    pending, info, labels = pipe.execute()
+    if not pending or not labels:
+        return None
+    page = {k.decode('utf-8'): v.decode('utf-8') for k, v in info.items()}
+    page['labels'] = {k.decode('utf-8'): v.decode('utf-8') for k, v in \
+        labels.items()}
+    page['key'] = key
+    return page
+
+
+def ack_page(entry_id, page):
+    """
+    Acknowledges a checked page. If no new changes were merged in the
+    meantime, the page is not pending anymore and its label aliases expire
+    after aliases_ttl seconds (until then, later renames on the same page
+    still resolve former labels). Otherwise the page stays pending, new
+    changes have already scheduled it again (see lst_poller.write_data()).
+    """
+    key = page['key'] if page else ''
+    ack_script(keys=['lstdata:labels:{}'.format(key), \
+        'lstdata:info:{}'.format(key), 'lstdata:origins:{}'.format(key), \
+        'lstdata:pages', 'lstdata:schedule', 'lstdata:stream'], args=[key, \
+        page['version'] if page else '', entry_id, group, aliases_ttl])
+
+
+def retry_page(entry_id, page):
+    """
+    Schedules a page whose transclusions could not be checked (see
+    check_saved_data()) again, due in retry_delay seconds, and acknowledges
+    its entry. Changes of the page stay pending. If the page is already
+    scheduled by a new change, its due time is kept.
+    """
+    logger.info('[RETRY PAGE] Checking [{}] again in {} seconds.'.format( \
+        page['title'], retry_delay))
+    redb.zadd('lstdata:schedule', {page['key']: time.time() + retry_delay}, \
+        nx=True)
+    ack_page(entry_id, None)
+
+
+# Acknowledges a checked page, see ack_page().
+# KEYS: labels hash, info hash, origins hash, pages set, schedule, stream
+# ARGV: page key, version of the checked changes, entry id, consumer group,
+#       ttl of resolved aliases
+ack_lua = """
+if ARGV[1] ~= '' and redis.call('HGET', KEYS[2], 'version') == ARGV[2] then
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+    redis.call('EXPIRE', KEYS[3], ARGV[5])
+    redis.call('SREM', KEYS[4], ARGV[1])
+    -- Changes scheduled again before the page was read are checked too
+    redis.call('ZREM', KEYS[5], ARGV[1])
+end
+redis.call('XACK', KEYS[6], ARGV[4], ARGV[3])
+redis.call('XDEL', KEYS[6], ARGV[3])
+"""
 
 
 def check_saved_data(data):
@@ -143,51 +417,93 @@ def check_saved_data(data):
             lang    - language of the project
             title   - title of the page
             labels  - dict with changed labels (key: old, value: new)
+            key     - key of the page in Redis (see load_page())
 
-    If page has transclusions and labels need to be updated, calls edit_page()
-    or edit_debug_mode() if we are in debug mode.
+    Returns set of keys of the input pages that could not be fully checked:
+    their transclusions could not be looked up, a transcluding page could
+    not be fetched or its check failed. They are checked again later (see
+    retry_page()).
+
+    Pages transcluding several of the input pages (eg. consecutive pages of
+    a volume) are fetched once and get a single edit with all corrections.
+    Contents of transcluding pages are fetched in batches (see
+    get_pagecontents()), then each of them is checked (see check_target()).
+    Both run in parallel in the thread pool of the wiki, at most
+    fetch_concurrency at a time, of which at most edit_concurrency are
+    editing.
     """
+    # Look up transclusions of all pages of each wiki at once
+    titles = {}
+    for page in data:
+        titles.setdefault(page['url'], []).append(page['title'])
+    found = {url: get_transclusions(url_titles, url) for url, url_titles in \
+        titles.items()}
+
+    # Group input pages by transcluding page: {url: {(id, title): [pages]}}
+    targets = {}
+    failed = set()
     for page in data:
-        edits = 0
-        transclusions = get_transclusions(page['title'], page['url'])
+        if page['title'] not in found[page['url']]:
+            failed.add(page['key'])
+            continue
+        transclusions = found[page['url']][page['title']]
         if not transclusions:
             logger.info('[CHECK SAVED DATA] No transclusions in [{}]. Pass.' \
                 .format(page['title']))
-        else:
-            logger.info('[CHECK SAVED DATA] Found {} transclusions for [{}].' \
-                ' Checking...'.format(len(transclusions), page['title']))
-            for transclusion in transclusions:
-                # Get source code of transcluding page
-                tr_content = get_pagecontent(page['url'], transclusion[0])
-                if tr_content:
-                    # Update lables in content if necessary
-                    new_content, corrected_labels = fix_transclusion(tr_content, \
-                        page['title'],page['labels'],page['lang'])
-                    if new_content:
-                        # Means labels need to be updated
-                        edit_sum,labels_sum = compose_summary(corrected_labels,\
-                            page['lang'])
-                        summary = '{} {}'.format(edit_sum, labels_sum)
-                        # TODO having both edit_sum and summary is a bit confusing
-                        if debug_mode:
-                            edited = edit_debug_mode(transclusion[1], page, \
-                                labels_sum)
-                            if edited:
-                                edits += 1
-                        else:
-                            edited = edit_page(page['url'], transclusion[0], \
-                                new_content, summary)
-                            if edited:
-                                edits += 1
-                    else:
-                        # Means no edit necessary
-                        logger.info('[CHECK SAVED DATA] No edit necessary in' \
-                            ' [{}]. Skipping'.format(transclusion[1]))
+            continue
+        logger.info('[CHECK SAVED DATA] Found {} transclusions for [{}].' \
+            ' Checking...'.format(len(transclusions), page['title']))
+        for transclusion in transclusions:
+            targets.setdefault(page['url'], {}).setdefault(transclusion, \
+                []).append(page)
+
+    fetches = []
+    for url, url_targets in targets.items():
+        pageids = [t[0] for t in url_targets]
+        executor = get_executor(url)
+        fetches.append((url, [(pageids[i:i + content_batch], \
+            executor.submit(get_pagecontents, url, pageids[i:i + \
+            content_batch])) for i in range(0, len(pageids), content_batch)]))
+
+    checks = []
+    for url, futures in fetches:
+        contents = {}
+        unavailable = set()
+        for pageids, future in futures:
+            try:
+                contents.update(future.result())
+            except ApiError:
+                unavailable.update(pageids)
+        executor = get_executor(url)
+        for transclusion, pages in targets[url].items():
+            if transclusion[0] in unavailable:
+                failed.update(page['key'] for page in pages)
+                continue
+            checks.append((transclusion, pages, executor.submit( \
+                check_target, url, transclusion, contents.get( \
+                transclusion[0]), pages)))
+
+    # Count edits for each input page
+    edits = {}
+    for transclusion, pages, future in checks:
+        try:
+            for key in future.result():
+                edits[key] = edits.get(key, 0) + 1
+        except Exception as e:
+            logger.warning('[CHECK SAVED DATA] Unable to check [{}] ' \
+                '({}). Skipping'.format(transclusion[1], e))
+            failed.update(page['key'] for page in pages)
+
+    for page in data:
+        transclusions = found[page['url']].get(page['title']) or []
         # Update log for current page
-        if edits:
+        if page['key'] in failed:
+            logger.warning('[CHECK SAVED DATA] Unable to check all ' \
+                'transclusions of [{}]. Retrying later.'.format(page['title']))
+        elif edits.get(page['key']):
             logger.info('[CHECK SAVED DATA] Done checking [{}]. In total {} ' \
             'corrections were made in {} transclusions.'.format(page['title'], \
-            edits,len(transclusions)))
+            edits[page['key']],len(transclusions)))
         else:
             logger.info('[CHECK SAVED DATA] Done checking [{}] with {} ' \
                 'transclusion(s). No corrections are necessary'.format \
@@ -195,20 +511,160 @@ def check_saved_data(data):
     # Update log for current sessions
     logger.info('[CHECK SAVED DATA] Ending session. Checked transclusions of' \
         ' {} pages.'.format(len(data)))
+    return failed
+
+
+def get_executor(url):
+    """
+    Returns the thread pool of the wiki, creates it (and its edit semaphore)
+    on first use.
+    """
+    if url not in executors:
+        executors[url] = ThreadPoolExecutor(max_workers=fetch_concurrency)
+        edit_limits[url] = threading.BoundedSemaphore(edit_concurrency)
+    return executors[url]
+
+
+def check_target(url, transclusion, tr_content, pages):
+    """
+    Updates labels of all given pages in a single transcluding page (tuple of
+    page-id and title), if necessary, with one edit. Calls edit_page() or
+    edit_debug_mode() if we are in debug mode. Runs in the thread pool, see
+    check_saved_data().
+
+    tr_content is the content of the transcluding page as returned by
+    get_pagecontents(), or None if it is not available. The edit is based on
+    its revision: if the page was edited since and MediaWiki reports an edit
+    conflict, the page is fetched and fixed again (at most max_conflicts
+    times). MediaWiki doesn't report conflicts with edits of the same user,
+    so other workers are kept out by a lock on the page (see page_lock())
+    and its latest revision is checked before saving.
+
+    Returns list of keys of the pages whose labels were corrected (empty if
+    the page was not edited).
+    """
+    for attempt in range(max_conflicts + 1):
+        if not tr_content or not tr_content['content']:
+            return []
+        content, corrected_pages, corrected_labels = fix_target( \
+            tr_content['content'], pages)
+        if not corrected_pages:
+            # Means no edit necessary
+            logger.info('[CHECK SAVED DATA] No edit necessary in' \
+                ' [{}]. Skipping'.format(transclusion[1]))
+            return []
+        # Means labels need to be updated
+        edit_sum,labels_sum = compose_summary(corrected_labels,\
+            pages[0]['lang'])
+        summary = '{} {}'.format(edit_sum, labels_sum)
+        # TODO having both edit_sum and summary is a bit confusing
+        try:
+            with edit_limits[url]:
+                if debug_mode:
+                    edited = edit_debug_mode(transclusion[1], \
+                        corrected_pages, labels_sum)
+                else:
+                    with page_lock(url, transclusion[0]):
+                        check_base(url, transclusion[0], tr_content)
+                        edited = edit_page(url, transclusion[0], content, \
+                            summary, base=tr_content)
+        except EditConflict:
+            logger.info('[CHECK SAVED DATA] [{}] was edited meanwhile. ' \
+                'Fetching it again.'.format(transclusion[1]))
+            tr_content = get_pagecontents(url, [transclusion[0]]).get( \
+                transclusion[0])
+            continue
+        return [page['key'] for page in corrected_pages] if edited else []
+    logger.warning('[CHECK SAVED DATA] Giving up on [{}] after {} edit ' \
+        'conflicts.'.format(transclusion[1], max_conflicts))
+    return []
+
+
+def check_base(url, pageid, tr_content):
+    """
+    Raises EditConflict if the page has been edited since tr_content was
+    fetched (eg. by another worker, whose edits are not conflicts for
+    MediaWiki, as all workers edit as the same user).
+    """
+    revid = get_lastrevids(url, [pageid]).get(pageid)
+    if revid is not None and revid != tr_content['revid']:
+        raise EditConflict(pageid)
+
+
+@contextmanager
+def page_lock(url, pageid):
+    """
+    Holds the lock of a transcluding page, shared by all workers:
+        lstdata:lock:<wiki>|<page id> - owner of the lock
+    Waits while another thread or worker holds it. The lock expires after
+    lock_ttl seconds, so a crashed worker can't keep it.
+    """
+    key = 'lstdata:lock:{}|{}'.format(url.split('/')[2], pageid)
+    owner = '{}:{}'.format(consumer, threading.get_ident())
+    while not redb.set(key, owner, nx=True, ex=lock_ttl):
+        time.sleep(0.5)
+    try:
+        yield
+    finally:
+        unlock_script(keys=[key], args=[owner])
 
 
-def edit_debug_mode(transclusion, page, labels_sum):
+# Releases the lock of a page if it is still held by the owner (it may have
+# expired and been taken by another worker), see page_lock().
+# KEYS: lock
+# ARGV: owner
+unlock_lua = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+"""
+
+
+def fix_target(content, pages):
+    """
+    Updates labels of all given pages in content of a transcluding page.
+    Labels of all pages are looked up in the original content and replaced
+    at once, so a label renamed for one page is not renamed again for
+    another (eg. a->b on page 12 and b->c on page 13).
+
+    Returns tuple of new content, list of corrected pages and list of
+    corrected labels (tuples of old and new label).
+    """
+    replacements = []
+    corrected_pages = []
+    corrected_labels = []
+    for page in pages:
+        number = re.search(r'\.(?:djvu|pdf)/(\d+)$', page['title'])
+        number = int(number.group(1)) if number else None
+        title = clean_title(page['title'])
+        if title not in content and title.replace(' ', '_') not in content:
+            continue
+        page_replacements, page_labels = find_replacements(content, title, \
+            number, page['labels'], page['lang'])
+        if page_replacements:
+            replacements.extend(page_replacements)
+            corrected_pages.append(page)
+            # Pages may rename the same label differently, keep all of them
+            corrected_labels.extend([l for l in page_labels.items() if l not \
+                in corrected_labels])
+    if replacements:
+        content = splice(content, replacements)
+    return content, corrected_pages, corrected_labels
+
+
+def edit_debug_mode(transclusion, pages, labels_sum):
     # Define data to write in file
     write_data = []
     # Timestamp
     write_data.append('\n\n<br/><br/>{}\n'.format(time.ctime()))
     # Url of the project
-    base_url = page['url'].split('/')[2]
+    base_url = pages[0]['url'].split('/')[2]
     write_data.append('<b>{}</b>\n'.format(base_url))
-    # Page with changed labels
-    original_page_url = 'https://{}/wiki/{}'.format(base_url,page['title'])
-    write_data.append('Original page: <a href="{}">{}</a>\n'.format \
-        (original_page_url,page['title']))
+    # Pages with changed labels
+    for page in pages:
+        original_page_url = 'https://{}/wiki/{}'.format(base_url,page['title'])
+        write_data.append('Original page: <a href="{}">{}</a>\n'.format \
+            (original_page_url,page['title']))
     # Page that should be edited
     target_page_url = 'https://{}/wiki/{}'.format(base_url,transclusion)
     write_data.append('Page to edit: <a href="{}">{}</a>\n'.format \
@@ -230,90 +686,117 @@ def set_status_on_wiki(url, status):
     """
     Updates bot status on bot subpage (in edited wiki project).
     Calls check_stopbutton() to update Stop button status.
-    Will not edit if button is ON or status page is not created.
-    """
-    if not debug_mode:
-        usr = user.split('@')[0]
-        page = 'User:' + usr + '/status'
-        button_exists = check_stopbutton(url, page)
-        if button_exists and not stop_button:
-            content = get_pagecontent(url, page)
-            status_template = '{{User:' + usr + '/status/' + status + '}}'
-            already_set = False
-            #TODO make sure template page exists and localize
-            if content:
-                for line in content.splitlines():
-                    if status_template in line:
-                        already_set = True
-            if not already_set:
-                #TODO localize summary
-                summary = 'Setting bot status to {}.'.format(status)
-                edit = edit_page(url, page, status_template, summary, force=True)
-                if edit: # Means edit was succes
-                    logger.info('[SET STATUS ON WIKI] Set bot status to {} ' \
-                        'in subpage [{}]'.format(status.upper(), page))
+    Will not edit if button is ON or status page is not created, or if the
+    status is already set (so normally once per run of the worker).
+
+    Returns True if Stop button is ON, otherwise False.
+    """
+    if debug_mode:
+        return False
+    usr = user.split('@')[0]
+    page = 'User:' + usr + '/status'
+    with status_lock:
+        state = check_stopbutton(url, page)
+        status_template = '{{User:' + usr + '/status/' + status + '}}'
+        #TODO make sure template page exists and localize
+        if state['exists'] and not state['stop'] and status_template not in \
+            state['content']:
+            #TODO localize summary
+            summary = 'Setting bot status to {}.'.format(status)
+            edit = edit_page(url, page, status_template, summary, force=True)
+            if edit: # Means edit was succes
+                state['content'] = status_template
+                logger.info('[SET STATUS ON WIKI] Set bot status to {} ' \
+                    'in subpage [{}]'.format(status.upper(), page))
+    return state['stop']
 
 
 def check_stopbutton(url, page):
     """
     Check user status page to see if user is allowed to edit.
-    If first line of the status page contains "stop", stop_button is ON.
-    This allows off-line control over the bot. If stop_botton is ON no edits
+    If first line of the status page contains "stop", stop button is ON.
+    This allows off-line control over the bot. If stop botton is ON no edits
     will be made.
 
-    Updates global stop_button.
-    Returns True if status page exists, otherwise False.
+    The page is read at most once in status_ttl seconds per wiki, so the stop
+    button takes effect within status_ttl seconds.
+
+    Returns dict (cached in wiki_states) with items:
+        exists  - True if status page exists, otherwise False
+        stop    - True if stop button is ON
+        content - content of the status page
+        checked - time of the last read
     """
-    global stop_button
+    state = wiki_states.get(url)
+    if state and time.time() - state['checked'] < status_ttl:
+        return state
     content = get_pagecontent(url, page)
-    # Page doesn't exist
-    if not content:
-        stop_button = False
-        return False
+    state = {'exists': bool(content), 'content': content or '', \
+        'checked': time.time()}
     # Page exists and stop botton is ON
-    elif 'stop' in content.splitlines()[0].lower():
-        stop_button = True
-    # Stop botton is OFF
-    else:
-        stop_button = False
-    return True
+    state['stop'] = bool(content) and 'stop' in content.splitlines()[0].lower()
+    wiki_states[url] = state
+    return state
 
 
-def get_transclusions(title, url):
+def get_transclusions(titles, url):
     """
-    Checks if page has transclusions. Returns a list of tuples if so, otherwise
-    None. Tuple is pair of page-id and title.
+    Finds pages transcluding any of the titles, in namespaces transclusion_ns
+    (50 titles per request, all transclusions are followed through API
+    continuation). Returns dict with title as key and list of tuples as value
+    (empty list if the title has no transclusions). Tuple is pair of page-id
+    and title. Titles that could not be checked are left out.
     """
-    parameters = {  'action': 'query',
-                    'prop': 'transcludedin',
-                    'titles': title,
-                    'format': 'json',
-                    'utf8': '',
-                    'tinamespace': '*'} #TODO change ns to 0?
-    try:
-        resp = (requests.get(url, params = parameters))
-        js = json.loads(resp.content.decode('utf-8'))
-        pid = [p for p in js['query']['pages'].keys()][0]
-        transclusions = js['query']['pages'][pid]
-    except:
-        logger.warning('[GET TRANSCLUSIONS] Unable to get transcusions of ' \
-            '[{}]. Unexpected or no reply from API [{}]'.format(title,url))
-        return None
-    else:
-        if 'transcludedin' in transclusions.keys():
-            return [(page['pageid'],page['title']) for page in \
-                transclusions['transcludedin']]
-        return None
+    transclusions = {}
+    for i in range(0, len(titles), 50):
+        batch = titles[i:i + 50]
+        parameters = {  'action': 'query',
+                        'prop': 'transcludedin',
+                        'titles': '|'.join(batch),
+                        'format': 'json',
+                        'utf8': '',
+                        'tilimit': 'max',
+                        'tinamespace': transclusion_ns }
+        found = {}
+        while True:
+            try:
+                resp = ratelimit.get(url, params = parameters)
+                js = json.loads(resp.content.decode('utf-8'))
+                # API returns titles in normalized form
+                normalized = {n['to']: n['from'] for n in js['query'].get( \
+                    'normalized', [])}
+                for page in js['query']['pages'].values():
+                    title = normalized.get(page['title'], page['title'])
+                    found.setdefault(title, []).extend([(p['pageid'], \
+                        p['title']) for p in page.get('transcludedin', [])])
+            except:
+                logger.warning('[GET TRANSCLUSIONS] Unable to get transcusions' \
+                    ' of [{}]. Unexpected or no reply from API [{}]'.format( \
+                    ', '.join(batch), url))
+                found = None
+                break
+            if 'continue' not in js:
+                break
+            parameters.update(js['continue'])
+        if found is not None:
+            transclusions.update(found)
+    return transclusions
 
 
 def fix_transclusion(page_content, title, labels, lang):
     """
     Checks if transclusion contains old labels and updates them in provided
-    page content. Three transclusion styles are checked consecutively, although
-    only the first is widely used in wiki projects.
+    page content. Three transclusion styles are checked, although only the
+    first is widely used in wiki projects:
 
-    Regex is used to make sure that labels are corrected only where necessary
-    (the page can for example transclude more than one pages).
+        <pages index="Title" from=1 to=2 fromsection="label" tosection=... />
+        {{#lst:Page:Title/1|label}}, {{#lstx:Title|label|text}}
+        {{page|Title/1|section=label}}    (localized, see localizations.py)
+
+    All of them are found in a single pass over the content (also if they
+    span several lines, see TransclusionParser) and only labels of the
+    transcluded page are replaced (the page can for example transclude more
+    than one pages).
 
     Input:
         page_content    - content of transcluding page
@@ -327,68 +810,249 @@ def fix_transclusion(page_content, title, labels, lang):
             dict      - updated labels (key: old, value: new)
         Both values will be None if no changes are necessary.
     """
-    page_content = page_content.splitlines()
+    # Page number of the transcluded page, eg. 535 in Page:Title.djvu/535
+    number = re.search(r'\.(?:djvu|pdf)/(\d+)$', title)
+    number = int(number.group(1)) if number else None
     title = clean_title(title) # Remove subpage and namespace from title
+    if title not in page_content and title.replace(' ', '_') not in \
+        page_content:
+        return None, None
+
+    replacements, corrected_labels = find_replacements(page_content, title, \
+        number, labels, lang)
+    if not replacements:
+        return None, None
+    return splice(page_content, replacements), corrected_labels
+
+
+def find_replacements(page_content, title, number, labels, lang):
+    """
+    Returns tuple of list of replacements (start, end, new label) of changed
+    labels of the title (cleaned, see clean_title()) in page_content and dict
+    of the replaced labels (key: old, value: new).
+    """
+    replacements = []
     corrected_labels = {}
-    edited = False
-
-    for line in page_content:
-        if title in line:
-            index = page_content.index(line) # Remember index of each line
-
-            # Case 1: HTML syntax for transclusion
-            if line.startswith('<pages index'):
-                for label in labels.keys():
-                    if label in line:
-                        # Check if transclusion template uses old label
-                        pattern = (r'(<pages index\s?=\s?"?{}"?\s.*?fromsection'
-                            '\s?=\s?"?)({}|.*)("?\s?tosection\s?=\s?"?)({}|.*)'
-                            '("?\s?/>)'.format(re.escape(title), label, label))
-                        match = re.search(pattern, line)
-                        if match:
-                            # Replace old label(s) with new label
-                            line = (re.sub(r'([from|to]section\s?=\s?"?){}'
-                                .format(label), r'\1{}'.format(labels[label]),
-                                line, count=2))
-                            page_content[index] = line
-                            corrected_labels[label] = labels[label]
-                            edited = True
-                            del match
-
-            # Case 2: Mediawiki syntax
-            if line.startswith('{{#lst:') or line.startswith('{{#lstx'):
-                for label in labels.keys():
-                    if label in line:
-                        pattern = (r'({{#lstx?:)(\w+:)?({})(/\d*)?([|]{})(}})'
-                            .format(title, label))
-                        match = re.search(pattern, line)
-                        if match:
-                            line = re.sub(pattern, r'\1\2\3\4|{}\6'.format
-                                (labels[label]), line)
-                            page_content[index] = line
-                            corrected_labels[label] = labels[label]
-                            edited = True
-                            del match
-
-            # Case 3: template used for transclusion
-            if template[lang] and line.lower().startswith(template[lang][0]):
-                for label in labels.keys():
-                    if label in line:
-                        pattern = (r'({}{})(/\d*)?(.*?)([|])(\w+)(\s?=\s?)({})'
-                            '(.*?}}$)'.format(template[lang][1], title, label))
-                        match = re.match(pattern, line)
-                        if match and match.group(5) in template[lang][2:]:
-                            line = (re.sub(pattern, r'\1\2\3\4\5\6{}\8'.format
-                                (labels[label]), line))
-                            page_content[index] = line
-                            corrected_labels[label] = labels[label]
-                            edited = True
-                            del match
-
-    page_content = '\n'.join(page_content)
-    if edited:
-        return page_content, corrected_labels
-    return None, None
+    for start, end, label in get_parser(lang).find_labels(page_content, \
+        title, number):
+        if label in labels:
+            replacements.append((start, end, labels[label]))
+            corrected_labels[label] = labels[label]
+    return replacements, corrected_labels
+
+
+def splice(text, replacements):
+    """
+    Applies replacements (start, end, new text) to text in a single pass.
+    Replacements overlapping an earlier one are skipped.
+    """
+    parts = []
+    position = 0
+    for start, end, new in sorted(replacements):
+        if start < position:
+            continue
+        parts.append(text[position:start])
+        parts.append(new)
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+
+def get_parser(lang):
+    """
+    Returns the TransclusionParser of the language, compiled on first use.
+    """
+    if lang not in parsers:
+        parsers[lang] = TransclusionParser(lang)
+    return parsers[lang]
+
+
+class TransclusionParser:
+    """
+    Finds section labels used in transclusions with a single precompiled
+    regex, only matched at the directives containing the title (see
+    tokens()), in one pass over the whole text. Directives may
+    span several lines, parameters are split by their offsets, so labels can
+    be replaced in place (see fix_transclusion()).
+    """
+
+    # Attributes of <pages/> with section labels
+    pages_attrs = ('fromsection', 'tosection', 'onlysection')
+    attr_re = re.compile(r'([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'/>]+))')
+    # Title in transclusions: optional namespace and page number
+    title_re = re.compile(r'^\s*(?:\w+:(?=\S))?(.*?)(?:/(\d*))?\s*$')
+
+    def __init__(self, lang):
+        tpl = template.get(lang) or []
+        directives = [r'(?P<pages><pages\s[^<>]*?/?>)',
+            r'(?P<lst>\{\{\s*#lstx?\s*:[^{}]*\}\})']
+        if tpl:
+            # Localized template, eg. {{[Pp]age[|]
+            directives.append(r'(?P<tpl>' + tpl[1] + r'[^{}]*\}\})')
+        self.params = set(tpl[2:])
+        self.regex = re.compile('|'.join(directives))
+
+    def find_labels(self, wikitext, title, number=None):
+        """
+        Returns list of tuples (start, end, label) of all labels of the title
+        in transclusions, in the order they appear in the text. If number of
+        the page is given, transclusions of other pages of the same file are
+        skipped.
+        """
+        title = title.replace('_', ' ')
+        underscored = title.replace(' ', '_')
+        labels = []
+        titles = [title] if underscored == title else [title, underscored]
+        for match in self.tokens(wikitext, titles):
+            text = match.group()
+            kind = match.lastgroup
+            if kind == 'pages':
+                found = self.parse_pages(text, title, number)
+            elif kind == 'lst':
+                found = self.parse_lst(text, title, number)
+            else:
+                found = self.parse_template(text, title, number)
+            start = match.start()
+            labels.extend([(start + s, start + e, label) for s, e, label in \
+                found])
+        return labels
+
+    def tokens(self, wikitext, titles):
+        """
+        Yields matches of directives containing any of the titles. Jumps
+        from one occurrence of a title to the next (str.find is much faster
+        than matching the regex at every directive) and matches the regex at
+        the nearest '<pages' or '{{' before it. Occurrences outside of
+        directives are skipped.
+        """
+        found = [wikitext.find(t) for t in titles]
+        end = 0     # End of the last directive, directives don't overlap
+        while True:
+            position = min([p for p in found if p != -1], default=-1)
+            if position == -1:
+                return
+            match = self.enclosing(wikitext, position, end)
+            if match:
+                yield match
+                end = match.end()
+            start = max(position + 1, end)
+            found = [wikitext.find(t, start) if p != -1 and p < start else p \
+                for t, p in zip(titles, found)]
+
+    def enclosing(self, wikitext, position, start):
+        """
+        Returns match of the directive (starting after start) that contains
+        position, or None.
+        """
+        for begin in sorted([wikitext.rfind('<pages', start, position), \
+            wikitext.rfind('{{', start, position)], reverse=True):
+            if begin == -1:
+                break
+            match = self.regex.match(wikitext, begin)
+            if match and match.end() > position:
+                return match
+        return None
+
+    def parse_pages(self, text, title, number):
+        """
+        <pages index="Title" ... fromsection="label" tosection="label" />
+        """
+        attrs = {}
+        for attr in self.attr_re.finditer(text):
+            group = next(g for g in (2, 3, 4) if attr.group(g) is not None)
+            attrs[attr.group(1).lower()] = (attr.start(group), attr.end(group),
+                attr.group(group))
+        if 'index' not in attrs or attrs['index'][2].strip().replace('_', \
+            ' ') != title:
+            return []
+        if number is None:
+            return [self.strip(value) for name, value in attrs.items() if \
+                name in self.pages_attrs]
+        first, last = [attrs[a][2].strip() if a in attrs else '' for a in \
+            ('from', 'to')]
+        first = int(first) if first.isdigit() else None
+        last = int(last) if last.isdigit() else None
+        if first is not None and number < first or last is not None and \
+            number > last:
+            return []
+        # fromsection is on the first page, tosection on the last one,
+        # onlysection on every page of the range
+        labels = []
+        for name, value in attrs.items():
+            if name == 'fromsection' and first not in (None, number) or \
+                name == 'tosection' and last not in (None, number):
+                continue
+            if name in self.pages_attrs:
+                labels.append(self.strip(value))
+        return labels
+
+    def parse_lst(self, text, title, number):
+        """
+        {{#lst:Title|label}}, {{#lst:Title|from|to}}, {{#lstx:Title|label|text}}
+        """
+        args = self.split_args(text, text.index(':') + 1)
+        if len(args) < 2 or not self.same_title(args[0][2], title, number):
+            return []
+        # Third argument of #lstx is replacement text, not a label
+        last = 2 if text.lstrip('{ ').startswith('#lstx') else 3
+        return [self.strip(arg) for arg in args[1:last]]
+
+    def parse_template(self, text, title, number):
+        """
+        {{page|Title/1|section=label}}
+        """
+        args = self.split_args(text, text.index('|') + 1)
+        if not args or not self.same_title(args[0][2], title, number):
+            return []
+        labels = []
+        for start, end, arg in args[1:]:
+            name, equals, value = arg.partition('=')
+            if equals and name.strip() in self.params:
+                labels.append(self.strip((start + len(name) + 1, end, value)))
+        return labels
+
+    @staticmethod
+    def split_args(text, start):
+        """
+        Returns list of tuples (start, end, text) of arguments separated by
+        '|', from start until the closing braces.
+        """
+        args = []
+        end = len(text) - 2
+        while start <= end:
+            stop = text.find('|', start, end)
+            if stop == -1:
+                stop = end
+            args.append((start, stop, text[start:stop]))
+            start = stop + 1
+        return args
+
+    @staticmethod
+    def strip(arg):
+        """
+        Removes surrounding whitespace from an argument, keeps its offsets.
+        """
+        start, end, text = arg
+        stripped = text.strip()
+        if not stripped:
+            return (start, end, stripped)
+        start += len(text) - len(text.lstrip())
+        return (start, start + len(stripped), stripped)
+
+    def same_title(self, arg, title, number):
+        """
+        True if the argument is the title, with or without namespace and
+        page number (if both have a page number, it has to be the same).
+        Titles of pages not in a file (eg. Page:Title/3) keep their subpage
+        (see clean_title()), then the subpage has to be the same.
+        """
+        match = self.title_re.match(arg)
+        name = match.group(1).replace('_', ' ')
+        if name != title:
+            return match.group(2) is not None and '{}/{}'.format(name, \
+                match.group(2)) == title
+        return number is None or not match.group(2) or int(match.group(2)) \
+            == number
 
 
 def clean_title(title):
@@ -430,7 +1094,7 @@ def get_pagecontent(url, page):
         return None
 
     try:
-        resp = requests.get(url, params = parameters)
+        resp = ratelimit.get(url, params = parameters)
         js = json.loads(resp.content.decode('utf-8'))
     except:
         logger.warning('[GET PAGECONTENT] Unable to get content of [{}]. ' \
@@ -445,7 +1109,192 @@ def get_pagecontent(url, page):
             return None
 
 
-def edit_page(url, page, page_content, summary, force=False):
+def get_pagecontents(url, pageids):
+    """
+    Retrieves contents of many pages, content_batch page ids per API request.
+    Contents in content_cache are reused if the page has not been edited
+    since (checked with a single request per batch, see get_lastrevids()).
+
+    Input:
+        url     - API of the project
+        pageids - list of page IDs (int)
+
+    Returns dict with page ID as key and dict with content, revid and
+    timestamp of the latest revision and starttimestamp (time of the request,
+    see edit_page()) as value. Pages that are missing or deleted are left
+    out. Raises ApiError if the API gave no or an unexpected reply.
+    """
+    started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    contents = {}
+    if content_cache:
+        cached = content_cache.get_many(url, pageids)
+        if cached:
+            for pid, revid in get_lastrevids(url, list(cached)).items():
+                if cached[pid]['revid'] == revid:
+                    contents[pid] = cached[pid]
+            logger.info('[GET PAGECONTENTS] Reused {} of {} page(s) from ' \
+                'cache.'.format(len(contents), len(pageids)))
+        pageids = [pid for pid in pageids if pid not in contents]
+
+    fetched = {}
+    for i in range(0, len(pageids), content_batch):
+        batch = pageids[i:i + content_batch]
+        parameters = {  'action': 'query',
+                        'prop': 'revisions',
+                        'rvprop': 'content|ids|timestamp',
+                        'pageids': '|'.join(str(p) for p in batch),
+                        'format': 'json',
+                        'utf8': '' }
+        # Large contents may not fit in one reply, then API continues
+        while True:
+            try:
+                resp = ratelimit.get(url, params = parameters)
+                js = json.loads(resp.content.decode('utf-8'))
+                for pid, info in js['query']['pages'].items():
+                    if 'revisions' in info:
+                        revision = info['revisions'][0]
+                        fetched[int(pid)] = {'content': revision.get('*'),
+                                             'revid': revision['revid'],
+                                             'timestamp': revision['timestamp']}
+            except:
+                logger.warning('[GET PAGECONTENTS] Unable to get contents of ' \
+                    '{} page(s). Unexpected or no reply from API [{}].'.format( \
+                    len(batch), url))
+                raise ApiError(url)
+            if 'continue' not in js:
+                break
+            parameters.update(js['continue'])
+        for pid in batch:
+            if pid not in fetched:
+                logger.warning('[GET PAGECONTENTS] Unable to get content of ' \
+                    '[{}]. Page is missing or deleted.'.format(pid))
+    if content_cache:
+        content_cache.put_many(url, fetched)
+    contents.update(fetched)
+    return {pid: dict(entry, starttimestamp=started) for pid, entry in \
+        contents.items()}
+
+
+def get_lastrevids(url, pageids):
+    """
+    Returns dict with page ID as key and ID of its latest revision as value
+    (prop=info, content_batch page ids per API request). Pages that are
+    missing or could not be checked are left out.
+    """
+    revids = {}
+    for i in range(0, len(pageids), content_batch):
+        batch = pageids[i:i + content_batch]
+        parameters = {  'action': 'query',
+                        'prop': 'info',
+                        'pageids': '|'.join(str(p) for p in batch),
+                        'format': 'json',
+                        'utf8': '' }
+        try:
+            resp = ratelimit.get(url, params = parameters)
+            js = json.loads(resp.content.decode('utf-8'))
+            pages = js['query']['pages']
+        except:
+            logger.warning('[GET LASTREVIDS] Unable to check {} page(s). ' \
+                'Unexpected or no reply from API [{}].'.format(len(batch), url))
+            continue
+        for pid, info in pages.items():
+            if 'lastrevid' in info:
+                revids[int(pid)] = info['lastrevid']
+    return revids
+
+
+class ContentCache:
+    """
+    Least recently used contents of transcluding pages (see
+    get_pagecontents()), keyed by wiki and page ID, with the revision they
+    belong to. The cache holds at most max_bytes of content. Pages larger
+    than a tenth of it are not kept in memory, so a few huge pages can't push
+    out everything else.
+
+    If spill is set, pages dropped from memory (and the large ones) are kept
+    in Redis for ttl seconds and read from there when needed again:
+        lstdata:cache:<wiki>|<page id> - hash with content, revid and timestamp
+    Shared by all threads of the worker.
+    """
+
+    def __init__(self, max_bytes, spill=False, ttl=3600):
+        self.max_bytes = max_bytes
+        self.max_entry = max_bytes // 10
+        self.spill = spill
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get_many(self, url, pageids):
+        """
+        Returns dict with page ID as key and cached content (dict with
+        content, revid and timestamp) as value, for pages found in cache.
+        """
+        found = {}
+        with self.lock:
+            for pid in pageids:
+                key = (url, pid)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[pid] = self.entries[key]
+        missing = [pid for pid in pageids if pid not in found]
+        if self.spill and missing:
+            pipe = redb.pipeline()
+            for pid in missing:
+                pipe.hgetall(self.redis_key(url, pid))
+            for pid, entry in zip(missing, pipe.execute()):
+                if entry:
+                    entry = {k.decode('utf-8'): v.decode('utf-8') for k, v in \
+                        entry.items()}
+                    entry['revid'] = int(entry['revid'])
+                    found[pid] = entry
+                    self.put(url, pid, entry, spilled=True)
+        return found
+
+    def put_many(self, url, contents):
+        """
+        Stores contents as returned by get_pagecontents().
+        """
+        for pid, entry in contents.items():
+            self.put(url, pid, entry)
+
+    def put(self, url, pid, entry, spilled=False):
+        """
+        Stores content of a page, drops least recently used pages if the
+        cache is full.
+        """
+        size = len(entry['content'] or '')
+        dropped = []
+        with self.lock:
+            key = (url, pid)
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)['content'] or '')
+            if size <= self.max_entry:
+                self.entries[key] = entry
+                self.size += size
+            elif not spilled:
+                dropped.append((key, entry))
+            while self.size > self.max_bytes:
+                old_key, old_entry = self.entries.popitem(last=False)
+                self.size -= len(old_entry['content'] or '')
+                dropped.append((old_key, old_entry))
+        if self.spill and dropped:
+            pipe = redb.pipeline()
+            for (old_url, old_pid), old_entry in dropped:
+                key = self.redis_key(old_url, old_pid)
+                pipe.hset(key, mapping={'content': old_entry['content'] or '',
+                    'revid': old_entry['revid'],
+                    'timestamp': old_entry['timestamp']})
+                pipe.expire(key, self.ttl)
+            pipe.execute()
+
+    @staticmethod
+    def redis_key(url, pid):
+        return 'lstdata:cache:{}|{}'.format(url.split('/')[2], pid)
+
+
+def edit_page(url, page, page_content, summary, force=False, base=None):
     """
     Edit wiki-page using provided credentials.
 
@@ -454,14 +1303,18 @@ def edit_page(url, page, page_content, summary, force=False):
         page            - can be either title (string) or ID (int).
         page_content    - string
         summary         - string, edit summary
+        base            - dict with revid, timestamp and starttimestamp of
+                          the revision page_content is based on (see
+                          get_pagecontents()), so that MediaWiki detects
+                          edits made in the meantime
 
     Returns:
         True            - if edit was success
         False           - edit didn't succeed
+    Raises EditConflict if the page was edited since the base revision.
     """
     if not force:
-        set_status_on_wiki(url, 'active')
-        if stop_button:
+        if set_status_on_wiki(url, 'active'):
             base_url = url.split('/')[2]
             logger.info('[EDIT PAGE] Stop button is ON. No edits will be made '\
                 'until it is turned OFF again.'.format(base_url))
@@ -470,72 +1323,12 @@ def edit_page(url, page, page_content, summary, force=False):
     # Continue in normal mode
     logger.info('[EDIT PAGE] Preparing to edit page [{}] through API [{}]' \
         .format(page,url))
-    session = requests.Session()
-
-    # Step 1: Request login token
-    logger.info('[EDIT PAGE] Logging in as [{}] in [{}]'.format(user, url))
-    params = {  'action': 'query',
-                'meta': 'tokens',
-                'type': 'login',
-                'format': 'json' }
-    try:
-        resp = session.get(url, params = params).json()
-    except:
-        logger.warning('[EDIT PAGE] Unable to get login token. Unexpected ' \
-            'or no API response: {}'.format(resp if resp else 'None'))
-        return False
-    else:
-        if not resp['query'] or not 'tokens' in resp['query']:
-            logger.warning('[EDIT PAGE] Login token request rejected. API ' \
-            'response: [{}]'.format(resp if resp else 'None'))
-            return False
-        login_token = resp['query']['tokens']['logintoken']
-        del resp
-
-    # Step 2: Login
-    logindata = {'action': 'login',
-                'format': 'json',
-                'lgname': user,
-                'lgpassword': pssw,
-                'lgtoken': login_token }
-    try:
-        resp = session.post(url, data = logindata).json()
-    except:
-        logger.warning('[EDIT PAGE] Unable to login to project. Unexpected ' \
-            'or no API response: {}'.format(resp if resp else 'None'))
-        return False
-    else:
-        if not resp['login'] or resp['login']['result'] != 'Success':
-            logger.warning('[EDIT PAGE] Log-in request rejected. API ' \
-            'response: [{}]'.format(resp if resp else 'None'))
-            return False
-        del resp
-
-    # Step 3: Request edit token
-    logger.info('[EDIT PAGE] Getting edit token....')
-    params['type'] = 'csrf'
-    try:
-        resp = session.get(url, params = params).json()
-    except:
-        logger.warning('[EDIT PAGE] Unable to get edit token. Unexpected or' \
-            ' no API response: {}'.format(resp if resp else 'None'))
-        return False
-    else:
-        if not resp or not 'tokens' in resp['query']:
-            logger.warning('[EDIT PAGE] Edit token request rejected. API ' \
-                'response: [{}]'.format(resp if resp else 'None'))
-            return False
-        edit_token = resp['query']['tokens']['csrftoken']
-        del resp
-
-    # Step 4: Edit page
     editdata = {'action': 'edit',
                 'text': page_content,
                 'summary': summary,
                 'format': 'json',
                 'utf8': '',
-                'bot': 1,
-                'token': edit_token }
+                'bot': 1 }
     if type(page) is int:
         editdata['pageid'] = page
     elif type(page) is str:
@@ -544,9 +1337,15 @@ def edit_page(url, page, page_content, summary, force=False):
         logger.warning('[EDIT PAGE] Argument [{}] has invalid type [{}]. ' \
             'Expected int or str. Aborting edit.'.format(page,type(page)))
         return False
+    if base:
+        editdata['baserevid'] = base['revid']
+        editdata['basetimestamp'] = base['timestamp']
+        editdata['starttimestamp'] = base['starttimestamp']
 
+    resp = get_session(url).edit(editdata)
+    if resp and resp.get('error', {}).get('code') == 'editconflict':
+        raise EditConflict(page)
     try:
-        resp = session.post(url, data = editdata).json()
         result = resp['edit']['result']
     except:
         logger.warning('[EDIT PAGE] Edit request rejected. API response: [{}]'\
@@ -562,14 +1361,157 @@ def edit_page(url, page, page_content, summary, force=False):
             return False
 
 
+class EditConflict(Exception):
+    pass
+
+
+class ApiError(Exception):
+    pass
+
+
+def get_session(url):
+    """
+    Returns the logged-in session of the bot in the wiki, creates it on first
+    use.
+    """
+    with sessions_lock:
+        if url not in sessions:
+            sessions[url] = WikiSession(url)
+        return sessions[url]
+
+
+class WikiSession:
+    """
+    Session of the bot in a single wiki, shared by all threads. Logs in once
+    and reuses the edit (CSRF) token for all edits. If the API rejects the
+    token or the session has expired, logs in again and retries the edit
+    once. So each edit is a single request.
+    """
+
+    # Errors after which the bot has to log in again
+    relogin_errors = ('badtoken', 'assertuserfailed', 'assertbotfailed', \
+        'notloggedin')
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+        self.token = None
+        self.lock = threading.Lock()
+
+    def edit(self, editdata):
+        """
+        Posts the edit (without token) and returns the API response, or None
+        if the bot is unable to log in or the API doesn't reply.
+        """
+        for attempt in range(2):
+            token = self.get_token()
+            if not token:
+                return None
+            data = dict(editdata, token=token)
+            data['assert'] = 'user'  # Fail instead of editing logged out
+            try:
+                resp = ratelimit.post(self.url, data = data, session = \
+                    self.session, kind = 'edit').json()
+            except:
+                logger.warning('[EDIT PAGE] Edit request rejected. No API ' \
+                    'response.')
+                return None
+            code = resp.get('error', {}).get('code')
+            if code not in self.relogin_errors or attempt:
+                return resp
+            logger.info('[EDIT PAGE] Session in [{}] expired ({}). Logging in ' \
+                'again.'.format(self.url, code))
+            with self.lock:
+                # Other threads may have logged in again meanwhile
+                if self.token == token:
+                    self.token = None
+
+    def get_token(self):
+        """
+        Returns the edit token, logs in first if there is none.
+        """
+        with self.lock:
+            if not self.token:
+                self.token = self.login()
+            return self.token
+
+    def login(self):
+        """
+        Logs in with the credentials of the bot. Returns edit token or None if
+        log-in failed.
+        """
+        url, session = self.url, self.session
+        session.cookies.clear()
+        resp = None
+
+        # Step 1: Request login token
+        logger.info('[EDIT PAGE] Logging in as [{}] in [{}]'.format(user, url))
+        params = {  'action': 'query',
+                    'meta': 'tokens',
+                    'type': 'login',
+                    'format': 'json' }
+        try:
+            resp = ratelimit.get(url, params = params, session = session) \
+                .json()
+        except:
+            logger.warning('[EDIT PAGE] Unable to get login token. Unexpected ' \
+                'or no API response: {}'.format(resp if resp else 'None'))
+            return None
+        else:
+            if not resp['query'] or not 'tokens' in resp['query']:
+                logger.warning('[EDIT PAGE] Login token request rejected. API ' \
+                'response: [{}]'.format(resp if resp else 'None'))
+                return None
+            login_token = resp['query']['tokens']['logintoken']
+            resp = None
+
+        # Step 2: Login
+        logindata = {'action': 'login',
+                    'format': 'json',
+                    'lgname': user,
+                    'lgpassword': pssw,
+                    'lgtoken': login_token }
+        try:
+            resp = ratelimit.post(url, data = logindata, session = session) \
+                .json()
+        except:
+            logger.warning('[EDIT PAGE] Unable to login to project. Unexpected ' \
+                'or no API response: {}'.format(resp if resp else 'None'))
+            return None
+        else:
+            if not resp['login'] or resp['login']['result'] != 'Success':
+                logger.warning('[EDIT PAGE] Log-in request rejected. API ' \
+                'response: [{}]'.format(resp if resp else 'None'))
+                return None
+            resp = None
+
+        # Step 3: Request edit token
+        logger.info('[EDIT PAGE] Getting edit token....')
+        params['type'] = 'csrf'
+        try:
+            resp = ratelimit.get(url, params = params, session = session) \
+                .json()
+        except:
+            logger.warning('[EDIT PAGE] Unable to get edit token. Unexpected or' \
+                ' no API response: {}'.format(resp if resp else 'None'))
+            return None
+        else:
+            if not resp or not 'tokens' in resp['query']:
+                logger.warning('[EDIT PAGE] Edit token request rejected. API ' \
+                    'response: [{}]'.format(resp if resp else 'None'))
+                return None
+            return resp['query']['tokens']['csrftoken']
+
+
 def compose_summary(labels, lang):
     """
-    Generates summary in local language with the labels that were changed.
+    Generates summary in local language with the labels that were changed
+    (list of tuples of old and new label).
 
     Returns tuple of two strings: edit_summary and changed labels
     """
     changes = []
-    for old, new in zip(labels.keys(), labels.values()):
+    for old, new in labels:
         changes.append(old + '→' + new)
     labels_summary = '({})'.format(', '.join(changes))
     return edit_summary[lang], labels_summary
@@ -0,0 +1,32 @@
+# !/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Names of the processes of LST-Guard, as used for their status in Redis.
+Shared by app.py, which starts the processes, and lst_manager.py, which
+addresses them, so it doesn't import anything (importing app would import
+lst_poller and lst_worker and open their log files).
+"""
+
+
+def split_shards(langs, shards):
+    """
+    Splits languages between poller shards. Returns list of tuples: name of
+    the shard and its languages. With a single shard the name is 'poller',
+    otherwise 'poller_1', ...
+    """
+    shards = max(1, min(shards, len(langs)))
+    if shards == 1:
+        return [('poller', langs)]
+    return [('poller_{}'.format(i + 1), langs[i::shards]) for i in \
+        range(shards)]
+
+
+def worker_names(workers):
+    """
+    Names of lst_worker processes. With a single worker the name is
+    'worker', otherwise 'worker_1', ...
+    """
+    if workers <= 1:
+        return ['worker']
+    return ['worker_{}'.format(i + 1) for i in range(workers)]
@@ -0,0 +1,217 @@
+# !/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Rate limiting of all requests to MediaWiki API (used by lst_poller and
+lst_worker). Requests of each wiki are limited with two token buckets: one
+for reads and one (usually much slower) for edits.
+
+Every request carries maxlag, so the servers refuse it when their replicas
+lag behind. If a request is refused (maxlag error, HTTP 429 or 503), the
+bucket halves its rate, waits as long as the server asks (Retry-After) and
+sends the request again. Each successful request raises the rate a little,
+up to the configured maximum.
+"""
+
+import requests
+import logging
+import threading
+import time
+
+global maxlag, max_retries, rates
+maxlag = 5          # Seconds of replication lag at which servers refuse
+max_retries = 5     # Retries of a refused request before giving up
+rates = {'read': 10.0, 'edit': 0.2}     # Maximum requests per second
+buckets = {}        # TokenBucket per (wiki, 'read' or 'edit')
+buckets_lock = threading.Lock()
+recorder = None     # Saves responses, see replay.Recorder
+player = None       # Answers requests from a recording, see replay.ApiPlayer
+api_url = None      # Replaces urls of the wikis, see configure()
+
+logger = logging.getLogger('ratelimit')
+_h = logging.FileHandler('logs/ratelimit.log')
+_h.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(message)s'))
+logger.addHandler(_h)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+
+def configure(read_rate=10.0, edit_rate=0.2, lag=5, retries=5, url=None):
+    """
+    Sets limits for all wikis (see app.load_config()). Must be called before
+    the first request.
+
+    Arguments:
+        read_rate (float)   - maximum reads per second in each wiki
+        edit_rate (float)   - maximum edits per second in each wiki
+        lag (int)           - maxlag parameter sent with every request
+        retries (int)       - retries of a refused request
+        url (string)        - API url to send requests to instead of the
+                              wikis, {server} is replaced with the server
+                              name of the wiki (eg. en.wikisource.org), see
+                              benchmarks/fake_api.py
+    """
+    global maxlag, max_retries, api_url
+    rates['read'] = read_rate
+    rates['edit'] = edit_rate
+    maxlag = lag
+    max_retries = retries
+    api_url = url or None
+
+
+def get(url, params=None, session=None, kind='read', **kwargs):
+    """
+    Rate limited requests.get() (or session.get()), see request().
+    """
+    params = dict(params or {}, maxlag=maxlag)
+    return request('get', url, kind, session, params=params, **kwargs)
+
+
+def post(url, data=None, session=None, kind='read', **kwargs):
+    """
+    Rate limited requests.post() (or session.post()), see request(). Edits
+    have to be posted with kind='edit'.
+    """
+    data = dict(data or {}, maxlag=maxlag)
+    return request('post', url, kind, session, data=data, **kwargs)
+
+
+def request(method, url, kind, session=None, **kwargs):
+    """
+    Sends the request when the bucket of the wiki allows it. Refused requests
+    are sent again (at most max_retries times), the response of the last one
+    is returned. Exceptions of requests are not caught.
+
+    When replaying a recording (see replay.py), requests are answered by the
+    player without limits.
+    """
+    if player:
+        return player.respond(method, url, kwargs)
+    bucket = get_bucket(url, kind)
+    sender = session or requests
+    target = api_url.format(server=url.split('/')[2]) if api_url else url
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        resp = sender.request(method, target, **kwargs)
+        delay = refused(resp)
+        if delay is None:
+            bucket.speed_up()
+            if recorder:
+                recorder.save(method, url, kwargs, resp)
+            return resp
+        bucket.slow_down(delay)
+        logger.warning('[REQUEST] {} refused request to [{}] (HTTP {}). ' \
+            'Retrying in {} s, {} rate is now {:.2f}/s'.format(url.split('/') \
+            [2], url, resp.status_code, delay, kind, bucket.rate))
+    return resp
+
+
+def refused(resp):
+    """
+    Returns number of seconds to wait if the server refused the request
+    (replication lag or too many requests), otherwise None.
+    """
+    retry_after = resp.headers.get('Retry-After')
+    if resp.status_code not in (429, 503) and retry_after is None:
+        return None
+    try:
+        return max(1, int(retry_after))
+    except (TypeError, ValueError):
+        return 5
+
+
+def get_bucket(url, kind):
+    """
+    Returns the TokenBucket of the wiki, creates it on first use.
+    """
+    key = (url.split('/')[2], kind)
+    with buckets_lock:
+        if key not in buckets:
+            buckets[key] = TokenBucket(rates[kind])
+        return buckets[key]
+
+
+def current_rates():
+    """
+    Returns dict with current rates (requests per second), key is tuple of
+    wiki and 'read' or 'edit'.
+    """
+    with buckets_lock:
+        return {key: bucket.rate for key, bucket in buckets.items()}
+
+
+def report_rates(redb, name, interval=60):
+    """
+    Saves current and maximum rates of the process in Redis every interval
+    seconds (shown by lst_manager -status):
+
+        lstdata:rates:<name>    - hash, '<wiki> <read or edit>' -> 'rate/max'
+
+    The hash expires when the process stops reporting. Runs in a separate
+    thread (see lst_poller.main() and lst_worker.main()).
+    """
+    key = 'lstdata:rates:{}'.format(name)
+    while True:
+        current = current_rates()
+        if current:
+            pipe = redb.pipeline()
+            pipe.delete(key)
+            pipe.hset(key, mapping={'{} {}'.format(wiki, kind): \
+                '{:.2f}/{:.2f}'.format(rate, rates[kind]) for (wiki, kind), \
+                rate in current.items()})
+            pipe.expire(key, interval * 3)
+            pipe.execute()
+        time.sleep(interval)
+
+
+class TokenBucket:
+    """
+    Allows max_rate requests per second on average, with bursts of up to
+    max_rate requests (at least one). The rate adapts: it is halved when the
+    server refuses a request and grows back by a twentieth of max_rate with
+    each successful one. Shared by all threads of the process.
+    """
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.capacity = max(1.0, max_rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0      # Set by slow_down()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Waits until a request can be sent.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - \
+                    self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def slow_down(self, delay):
+        """
+        Halves the rate and blocks all requests for delay seconds.
+        """
+        with self.lock:
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+            self.tokens = min(self.tokens, 1)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + \
+                delay)
+
+    def speed_up(self):
+        """
+        Raises the rate back towards max_rate.
+        """
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
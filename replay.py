@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import sys
+import threading
+import time
+from sseclient import Event
+
+__doc__ = """
+LST-Guard replay: record the recent changes stream and replay it to
+lst_poller, to measure its throughput and detection latency offline.
+
+Recordings are gzipped files with one JSON object per line: stream events
+and optionally the API responses of the poller. play also reads plain
+(not gzipped) files, eg. benchmarks/fixtures/events.jsonl, edits of the
+pages of benchmarks/fixtures/fake_wiki.json to replay against the fake API
+(see benchmarks/fake_api.py).
+
+USAGE:
+    python3 replay.py record <file> <seconds> [--api] [--db <db>]
+    python3 replay.py play <file> [speed] [--api] [--db <db>]
+
+ARGUMENTS:
+    record      Run lst_poller on the live stream for <seconds> and save all
+                events (of all wikis, so the recording can be replayed with
+                other languages) in <file>. Detected changes and the stream
+                position are not saved in Redis.
+    play        Run lst_poller on events from <file>
+    speed       1 for real time (default), eg. 10 for ten times faster, 0 for
+                as fast as possible
+    --api       record: also save responses of API requests
+                play: answer API requests from the recording instead of the
+                live wikis
+    --db        Redis db to use instead of the one in config.ini. Pages found
+                in a replay are queued for workers, so don't replay into the
+                database of running workers! A recording only saves the
+                status of the poller.
+
+Settings (project, languages, Redis, [poller]) are read from config.ini.
+"""
+
+
+class Recorder:
+    """
+    Writes events and API responses to a recording, shared by all threads.
+    Times are saved in seconds since the recording started.
+    """
+
+    def __init__(self, path):
+        self.file = gzip.open(path, 'wt', encoding='utf-8')
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.events = 0
+
+    def write(self, record):
+        record['t'] = round(time.monotonic() - self.started, 3)
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def write_event(self, event):
+        """
+        Saves a stream event (called by lst_poller.main()).
+        """
+        self.events += 1
+        self.write({'kind': 'event', 'id': event.id, 'event': event.event,
+            'data': event.data})
+
+    def save(self, method, url, kwargs, resp):
+        """
+        Saves an API response (called by ratelimit.request()).
+        """
+        self.write({'kind': 'api', 'method': method, 'url': url,
+            'params': request_params(kwargs), 'status': resp.status_code,
+            'body': resp.content.decode('utf-8')})
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_recording(path, kind):
+    """
+    Yields records of the given kind ('event' or 'api') from a recording.
+    """
+    # Recordings are gzipped, fixtures may be plain text
+    with open(path, 'rb') as f:
+        opener = gzip.open if f.read(2) == b'\x1f\x8b' else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['kind'] == kind:
+                yield record
+
+
+class ReplaySource:
+    """
+    Yields recorded events (sseclient.Event) with their original timing,
+    divided by speed (speed 0 yields them as fast as possible). Can be used
+    by lst_poller.main() instead of the live stream.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.events = 0
+
+    def __iter__(self):
+        started = time.monotonic()
+        for record in read_recording(self.path, 'event'):
+            if self.speed:
+                wait = record['t'] / self.speed - (time.monotonic() - started)
+                if wait > 0:
+                    time.sleep(wait)
+            self.events += 1
+            yield Event(data=record['data'], event=record['event'],
+                id=record['id'])
+
+
+class ApiPlayer:
+    """
+    Answers API requests from a recording (see ratelimit.request()).
+    Requests are matched by url and parameters. Revision texts are matched
+    one by one, as edits are batched differently in each run (see
+    lst_poller.RevisionBatcher). Requests that are not in the recording get
+    HTTP 404.
+    """
+
+    def __init__(self, path):
+        self.responses = {}
+        self.revisions = {}     # revid: (page id, page without revisions, rev)
+        self.bad_revids = set()
+        self.misses = 0
+        for record in read_recording(path, 'api'):
+            key = request_key(record['method'], record['url'], \
+                record['params'])
+            self.responses.setdefault(key, (record['status'], \
+                record['body']))
+            if 'revids' in record['params'] and record['status'] == 200:
+                self.index_revisions(record['url'], record['body'])
+
+    def index_revisions(self, url, body):
+        try:
+            query = json.loads(body)['query']
+        except (ValueError, KeyError):
+            return
+        for revid in query.get('badrevids', {}):
+            self.bad_revids.add((url, int(revid)))
+        for pageid, page in query.get('pages', {}).items():
+            info = {k: v for k, v in page.items() if k != 'revisions'}
+            for rev in page.get('revisions', []):
+                self.revisions[(url, rev['revid'])] = (pageid, info, rev)
+
+    def respond(self, method, url, kwargs):
+        params = request_params(kwargs)
+        if 'revids' in params:
+            return self.respond_revisions(url, params)
+        key = request_key(method, url, params)
+        if key not in self.responses:
+            self.misses += 1
+            return Response(404, '')
+        return Response(*self.responses[key])
+
+    def respond_revisions(self, url, params):
+        pages = {}
+        bad = {}
+        for revid in str(params['revids']).split('|'):
+            found = self.revisions.get((url, int(revid)))
+            if found:
+                pageid, info, rev = found
+                pages.setdefault(pageid, dict(info, revisions=[]))[ \
+                    'revisions'].append(rev)
+            else:
+                if (url, int(revid)) not in self.bad_revids:
+                    self.misses += 1
+                bad[revid] = {'revid': int(revid)}
+        query = {'pages': pages}
+        if bad:
+            query['badrevids'] = bad
+        return Response(200, json.dumps({'query': query}))
+
+
+class Response:
+    """
+    Recorded API response, with the parts of requests.Response used by
+    lst_poller and lst_worker.
+    """
+
+    def __init__(self, status, body):
+        self.status_code = status
+        self.content = body.encode('utf-8')
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+def request_params(kwargs):
+    """
+    Parameters of a request without the ones that differ between runs.
+    """
+    params = dict(kwargs.get('params') or kwargs.get('data') or {})
+    for name in ('maxlag', 'token', 'lgtoken', 'lgpassword'):
+        params.pop(name, None)
+    return {k: str(v) for k, v in params.items()}
+
+
+def request_key(method, url, params):
+    return json.dumps([method, url, sorted(params.items())])
+
+
+def run_poller(name, db=None, **kwargs):
+    """
+    Runs lst_poller with settings from config.ini.
+    """
+    import app
+    import lst_poller
+    import ratelimit
+    app.config_fp = 'config.ini'
+    app.load_config()
+    ratelimit.configure(**app.api_opts)
+    rdb = app.rdb if db is None else (app.rdb[0], app.rdb[1], db)
+    lst_poller.main(app.proj, app.langs, rdb, name=name, **dict( \
+        app.poller_opts, **kwargs))
+
+
+def record(path, seconds, api=False, db=None):
+    import lst_poller
+    import ratelimit
+    recorder = Recorder(path)
+    if api:
+        ratelimit.recorder = recorder
+    # Stop the poller (and the recording) after the given time
+    threading.Timer(seconds, lst_poller.stop_event.set).start()
+    try:
+        run_poller('recorder', db=db, recorder=recorder)
+    finally:
+        recorder.close()
+        print('Recorded {} events in [{}].'.format(recorder.events, path))
+
+
+def play(path, speed=1.0, api=False, db=None):
+    import ratelimit
+    if api:
+        ratelimit.player = ApiPlayer(path)
+    try:
+        run_poller('replay', db=db, events=ReplaySource(path, speed))
+    finally:
+        if api:
+            print('API requests missing in the recording: {}'.format( \
+                ratelimit.player.misses))
+
+
+def main():
+    args = sys.argv[1:]
+    api = '--api' in args
+    if api:
+        args.remove('--api')
+    db = None
+    if '--db' in args and args.index('--db') + 1 < len(args):
+        db = args.pop(args.index('--db') + 1)
+        args.remove('--db')
+    if len(args) == 3 and args[0] == 'record':
+        record(args[1], float(args[2]), api, db)
+    elif len(args) in (2, 3) and args[0] == 'play':
+        play(args[1], float(args[2]) if len(args) == 3 else 1.0, api, db)
+    else:
+        print(__doc__)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
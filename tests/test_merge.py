@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of merging changed labels into the alias map of a page (merge_lua, see
+lst_poller.write_data()), against fakeredis.
+
+Run from the root of the repository:
+    python3 -m unittest discover tests
+"""
+
+import json
+import os
+import unittest
+
+import fakeredis
+
+os.makedirs('logs', exist_ok=True)  # Required by lst_poller logger
+import lst_poller
+
+url = 'https://en.wikisource.org/w/api.php'
+key = 'en.wikisource.org|Page:Volume 1.djvu/12'
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redb = fakeredis.FakeStrictRedis()
+        lst_poller.redb = self.redb
+        lst_poller.merge_script = self.redb.register_script( \
+            lst_poller.merge_lua)
+
+    def edit(self, *renames):
+        """
+        Saves one edit with the given (old, new) label pairs.
+        """
+        lst_poller.write_data({'title': 'Page:Volume 1.djvu/12', 'lang': \
+            'en', 'url': url, 'labels': dict(renames)})
+
+    def labels(self):
+        return {k.decode('utf-8'): v.decode('utf-8') for k, v in \
+            self.redb.hgetall('lstdata:labels:{}'.format(key)).items()}
+
+    def origins(self):
+        return {k.decode('utf-8'): json.loads(v.decode('utf-8')) for k, v in \
+            self.redb.hgetall('lstdata:origins:{}'.format(key)).items()}
+
+    def test_rename(self):
+        self.edit(('a', 'b'))
+        self.assertEqual(self.labels(), {'a': 'b'})
+        self.assertEqual(self.origins(), {'b': ['a']})
+
+    def test_chain(self):
+        # a->b, b->c: transclusions with a or b are updated to c
+        self.edit(('a', 'b'))
+        self.edit(('b', 'c'))
+        self.assertEqual(self.labels(), {'a': 'c', 'b': 'c'})
+        self.assertEqual(self.origins(), {'c': ['b', 'a']})
+
+    def test_swap_in_one_edit(self):
+        # a<->b in one edit is a swap, not a chain back to the same label
+        self.edit(('a', 'b'), ('b', 'a'))
+        self.assertEqual(self.labels(), {'a': 'b', 'b': 'a'})
+        self.assertEqual(self.origins(), {'b': ['a'], 'a': ['b']})
+
+    def test_shift_in_one_edit(self):
+        # a->b, b->c in one edit: a is now b, the former b is now c
+        self.edit(('a', 'b'), ('b', 'c'))
+        self.assertEqual(self.labels(), {'a': 'b', 'b': 'c'})
+        self.assertEqual(self.origins(), {'b': ['a'], 'c': ['b']})
+
+    def test_shift_after_chain(self):
+        # Former labels of a shifted label follow it, not the label taking
+        # its name
+        self.edit(('x', 'a'))
+        self.edit(('a', 'b'), ('b', 'c'))
+        self.assertEqual(self.labels(), {'x': 'b', 'a': 'b', 'b': 'c'})
+        self.assertEqual(self.origins(), {'b': ['a', 'x'], 'c': ['b']})
+
+    def test_revert(self):
+        # a->b, b->a: a is current again, only b->a is kept
+        self.edit(('a', 'b'))
+        self.edit(('b', 'a'))
+        self.assertEqual(self.labels(), {'b': 'a'})
+        self.assertEqual(self.origins(), {'a': ['b']})
+
+    def test_revert_of_chain(self):
+        self.edit(('a', 'b'))
+        self.edit(('b', 'c'))
+        self.edit(('c', 'a'))
+        self.assertEqual(self.labels(), {'b': 'a', 'c': 'a'})
+        self.assertEqual(self.origins(), {'a': ['c', 'b']})
+
+    def test_reuse_of_former_label(self):
+        # a->b, then c->a: a is a current label again, not a former b
+        self.edit(('a', 'b'))
+        self.edit(('c', 'a'))
+        self.assertEqual(self.labels(), {'c': 'a'})
+        self.assertEqual(self.origins(), {'a': ['c']})
+
+    def test_reuse_of_former_label_in_chain(self):
+        # x->a, a->b, then y->x: only a still resolves to b
+        self.edit(('x', 'a'))
+        self.edit(('a', 'b'))
+        self.edit(('y', 'x'))
+        self.assertEqual(self.labels(), {'a': 'b', 'y': 'x'})
+        self.assertEqual(self.origins(), {'b': ['a'], 'x': ['y']})
+
+    def test_reuse_while_renaming_its_target(self):
+        # a->b, then b->x and y->a in one edit: a is not renamed to x
+        self.edit(('a', 'b'))
+        self.edit(('b', 'x'), ('y', 'a'))
+        self.assertEqual(self.labels(), {'b': 'x', 'y': 'a'})
+        self.assertEqual(self.origins(), {'x': ['b'], 'a': ['y']})
+
+    def test_version_and_schedule(self):
+        self.edit(('a', 'b'))
+        self.edit(('b', 'c'))
+        info = self.redb.hgetall('lstdata:info:{}'.format(key))
+        self.assertEqual(info[b'version'], b'2')
+        self.assertEqual(info[b'title'], b'Page:Volume 1.djvu/12')
+        self.assertTrue(self.redb.sismember('lstdata:pages', key))
+        self.assertIsNotNone(self.redb.zscore('lstdata:schedule', key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the queue of pages between poller and workers (promote_lua,
+ack_lua, lst_worker.read_pages() and lst_worker.find_stale()), against
+fakeredis.
+
+Run from the root of the repository:
+    python3 -m unittest discover tests
+"""
+
+import os
+import time
+import unittest
+
+import fakeredis
+
+os.makedirs('logs', exist_ok=True)  # Required by lst_poller/worker loggers
+import lst_poller
+import lst_worker
+
+url = 'https://en.wikisource.org/w/api.php'
+key = 'en.wikisource.org|Page:Volume 1.djvu/12'
+
+
+class QueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redb = fakeredis.FakeStrictRedis()
+        lst_poller.redb = self.redb
+        lst_poller.merge_script = self.redb.register_script( \
+            lst_poller.merge_lua)
+        self.grace = lst_poller.grace
+        lst_poller.grace = 0
+        lst_worker.redb = self.redb
+        lst_worker.ack_script = self.redb.register_script(lst_worker.ack_lua)
+        lst_worker.promote_script = self.redb.register_script( \
+            lst_worker.promote_lua)
+        lst_worker.aliases_ttl = 60
+        lst_worker.consumer = 'worker'
+        lst_worker.recovering = False
+        lst_worker.create_group()
+
+    def tearDown(self):
+        lst_poller.grace = self.grace
+
+    def edit(self, title='Page:Volume 1.djvu/12', labels={'a': 'b'}):
+        lst_poller.write_data({'title': title, 'lang': 'en', 'url': url, \
+            'labels': labels})
+
+    def pending(self):
+        return self.redb.xpending('lstdata:stream', lst_worker.group)[ \
+            'pending']
+
+    def take(self, consumer, count):
+        """
+        Reads count new entries as another worker, without acking them.
+        """
+        return self.redb.xreadgroup(lst_worker.group, consumer, \
+            {'lstdata:stream': '>'}, count=count)[0][1]
+
+    def test_promote_due(self):
+        self.edit()
+        self.redb.zadd('lstdata:schedule', {'later': time.time() + 100})
+        next_due = lst_worker.promote_due()
+        self.assertAlmostEqual(next_due, time.time() + 100, delta=5)
+        self.assertEqual(self.redb.zrange('lstdata:schedule', 0, -1), \
+            [b'later'])
+        entries = self.redb.xrange('lstdata:stream')
+        self.assertEqual([fields for entry_id, fields in entries], \
+            [{b'page': key.encode('utf-8')}])
+
+    def test_promote_nothing_scheduled(self):
+        self.assertIsNone(lst_worker.promote_due())
+        self.assertEqual(self.redb.xlen('lstdata:stream'), 0)
+
+    def test_read_and_ack(self):
+        self.edit()
+        lst_worker.promote_due()
+        entries = lst_worker.read_pages(900)
+        self.assertEqual(len(entries), 1)
+        entry_id, page = entries[0]
+        self.assertEqual(page['labels'], {'a': 'b'})
+        self.assertEqual(page['version'], '1')
+        self.assertEqual(page['key'], key)
+        lst_worker.ack_page(entry_id, page)
+        self.assertFalse(self.redb.sismember('lstdata:pages', key))
+        self.assertGreater(self.redb.ttl('lstdata:labels:{}'.format(key)), 0)
+        self.assertEqual(self.redb.xlen('lstdata:stream'), 0)
+        self.assertEqual(self.pending(), 0)
+        self.assertEqual(lst_worker.read_pages(900), [])
+
+    def test_ack_of_older_version(self):
+        # Changes merged while the page was checked keep it pending
+        self.edit()
+        lst_worker.promote_due()
+        entry_id, page = lst_worker.read_pages(900)[0]
+        self.edit(labels={'c': 'd'})
+        lst_worker.ack_page(entry_id, page)
+        self.assertTrue(self.redb.sismember('lstdata:pages', key))
+        self.assertEqual(self.redb.ttl('lstdata:labels:{}'.format(key)), -1)
+        self.assertIsNotNone(self.redb.zscore('lstdata:schedule', key))
+        self.assertEqual(self.pending(), 0)
+
+    def test_ack_of_rescheduled_page(self):
+        # Changes scheduled again before the page was read are checked too
+        self.edit()
+        lst_worker.promote_due()
+        self.edit(labels={'c': 'd'})
+        entry_id, page = lst_worker.read_pages(900)[0]
+        self.assertEqual(page['version'], '2')
+        lst_worker.ack_page(entry_id, page)
+        self.assertFalse(self.redb.sismember('lstdata:pages', key))
+        self.assertIsNone(self.redb.zscore('lstdata:schedule', key))
+
+    def test_entry_of_checked_page(self):
+        # Page promoted twice, the second entry has nothing to check
+        self.edit()
+        lst_worker.promote_due()
+        self.edit()
+        lst_worker.promote_due()
+        first, second = lst_worker.read_pages(900)
+        lst_worker.ack_page(*first)
+        self.assertIsNone(lst_worker.load_page(key))
+        lst_worker.ack_page(second[0], None)
+        self.assertEqual(self.pending(), 0)
+        self.assertEqual(self.redb.xlen('lstdata:stream'), 0)
+
+    def test_retry_page(self):
+        self.edit()
+        lst_worker.promote_due()
+        entry_id, page = lst_worker.read_pages(900)[0]
+        lst_worker.retry_page(entry_id, page)
+        self.assertTrue(self.redb.sismember('lstdata:pages', key))
+        self.assertGreater(self.redb.zscore('lstdata:schedule', key), \
+            time.time())
+        self.assertEqual(self.pending(), 0)
+
+    def test_recover_own_entries(self):
+        # Entries read before a restart are read again first
+        for i in range(3):
+            self.edit('Page:Volume 1.djvu/{}'.format(i))
+        lst_worker.promote_due()
+        read = lst_worker.read_pages(900, count=2)
+        self.edit('Page:Volume 1.djvu/9')
+        lst_worker.promote_due()
+        lst_worker.recovering = True
+        self.assertEqual(lst_worker.read_pages(900), read)
+        for entry in read:
+            lst_worker.ack_page(*entry)
+        # Nothing left to recover, new entries are read
+        titles = [page['title'] for entry_id, page in \
+            lst_worker.read_pages(900)]
+        self.assertFalse(lst_worker.recovering)
+        self.assertEqual(titles, ['Page:Volume 1.djvu/2', \
+            'Page:Volume 1.djvu/9'])
+
+    def test_take_over_stale_entries(self):
+        self.edit()
+        lst_worker.promote_due()
+        entry_id = self.take('crashed', 1)[0][0]
+        # Not idle long enough
+        self.assertEqual(lst_worker.read_pages(900), [])
+        time.sleep(0.01)
+        entries = lst_worker.read_pages(0)
+        self.assertEqual([e[0] for e in entries], [entry_id])
+        consumers = self.redb.xpending_range('lstdata:stream', \
+            lst_worker.group, '-', '+', 10)
+        self.assertEqual(consumers[0]['consumer'], b'worker')
+
+    def test_find_stale_pages(self):
+        # More than one page of XPENDING (100 entries)
+        for i in range(250):
+            self.redb.xadd('lstdata:stream', {'page': str(i)})
+        taken = [entry_id for entry_id, fields in self.take('crashed', 250)]
+        time.sleep(0.01)
+        self.assertEqual(lst_worker.find_stale(0, 300), taken)
+        self.assertEqual(lst_worker.find_stale(0, 120), taken[:120])
+        self.assertEqual(lst_worker.find_stale(900, 300), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of finding and fixing labels in transclusions (see
+lst_worker.fix_transclusion() and lst_worker.fix_target()).
+
+Run from the root of the repository:
+    python3 -m unittest discover tests
+"""
+
+import os
+import unittest
+
+os.makedirs('logs', exist_ok=True)  # Required by lst_worker logger
+import lst_worker
+from lst_worker import fix_transclusion
+
+url = 'https://en.wikisource.org/w/api.php'
+
+
+def page(title, labels):
+    return {'title': title, 'labels': labels, 'lang': 'en', 'url': url,
+        'key': title}
+
+
+class DirectiveTest(unittest.TestCase):
+
+    def fix(self, text, title='Page:Vol.djvu/12', labels={'a': 'b'}):
+        return fix_transclusion(text, title, labels, 'en')[0]
+
+    def test_pages(self):
+        self.assertEqual(self.fix('<pages index="Vol.djvu" from=12 to=12 ' \
+            'fromsection="a" tosection=a />'), '<pages index="Vol.djvu" ' \
+            'from=12 to=12 fromsection="b" tosection=b />')
+
+    def test_pages_onlysection(self):
+        self.assertEqual(self.fix("<pages index='Vol.djvu' include=12 " \
+            "onlysection='a'/>"), "<pages index='Vol.djvu' include=12 " \
+            "onlysection='b'/>")
+
+    def test_pages_other_index(self):
+        self.assertIsNone(self.fix('<pages index="Vol 2.djvu" from=12 to=12 ' \
+            'fromsection=a tosection=a />'))
+
+    def test_lst(self):
+        self.assertEqual(self.fix('{{#lst:Page:Vol.djvu/12|a}}'), \
+            '{{#lst:Page:Vol.djvu/12|b}}')
+
+    def test_lst_range(self):
+        self.assertEqual(self.fix('{{#lst:Page:Vol.djvu/12| a |c}}', \
+            labels={'a': 'b', 'c': 'd'}), '{{#lst:Page:Vol.djvu/12| b |d}}')
+
+    def test_lstx(self):
+        # Third argument of #lstx is replacement text, not a label
+        self.assertEqual(self.fix('{{#lstx:Page:Vol.djvu/12|a|a}}'), \
+            '{{#lstx:Page:Vol.djvu/12|b|a}}')
+
+    def test_template(self):
+        self.assertEqual(self.fix('{{page|Vol.djvu/12|num=1|section=a}}'), \
+            '{{page|Vol.djvu/12|num=1|section=b}}')
+
+    def test_template_section_x(self):
+        self.assertEqual(self.fix('{{Page|Vol.djvu/12|section-x=a}}'), \
+            '{{Page|Vol.djvu/12|section-x=b}}')
+
+    def test_underscores(self):
+        self.assertEqual(self.fix('{{#lst:Page:Old_vol.djvu/12|a}}', \
+            'Page:Old vol.djvu/12'), '{{#lst:Page:Old_vol.djvu/12|b}}')
+        self.assertEqual(self.fix('<pages index="Old_vol.djvu" from=12 ' \
+            'to=12 onlysection=a />', 'Page:Old vol.djvu/12'), '<pages ' \
+            'index="Old_vol.djvu" from=12 to=12 onlysection=b />')
+
+    def test_other_page_number(self):
+        self.assertIsNone(self.fix('{{#lst:Page:Vol.djvu/13|a}}'))
+        self.assertIsNone(self.fix('{{page|Vol.djvu/13|section=a}}'))
+
+    def test_page_without_file(self):
+        # Titles not in a djvu/pdf file keep their subpage
+        self.assertEqual(self.fix('{{#lst:Page:Foo/3|a}}', 'Page:Foo/3'), \
+            '{{#lst:Page:Foo/3|b}}')
+        self.assertIsNone(self.fix('{{#lst:Page:Foo/4|a}}', 'Page:Foo/3'))
+
+    def test_exact_label(self):
+        self.assertIsNone(self.fix('{{#lst:Page:Vol.djvu/12|ab}}'))
+
+    def test_multiline(self):
+        self.assertEqual(self.fix('<pages index="Vol.djvu"\nfrom=12 to=12\n' \
+            'fromsection=a tosection=a\n/>'), '<pages index="Vol.djvu"\n' \
+            'from=12 to=12\nfromsection=b tosection=b\n/>')
+
+    def test_several_directives(self):
+        text = 'Vol.djvu/12 a\n{{#lst:Page:Vol.djvu/11|a}}\n' \
+            '{{#lst:Page:Vol.djvu/12|a}} {{page|Vol.djvu/12|section=a}}'
+        self.assertEqual(self.fix(text), 'Vol.djvu/12 a\n' \
+            '{{#lst:Page:Vol.djvu/11|a}}\n{{#lst:Page:Vol.djvu/12|b}} ' \
+            '{{page|Vol.djvu/12|section=b}}')
+
+
+class PagesRangeTest(unittest.TestCase):
+
+    text = '<pages index="Vol.djvu" from=10 to=14 fromsection=s1 ' \
+        'tosection=s1 />'
+
+    def test_middle_page(self):
+        # Labels of the first and last page are not labels of page 12
+        self.assertEqual(fix_transclusion(self.text, 'Page:Vol.djvu/12', \
+            {'s1': 's2'}, 'en'), (None, None))
+
+    def test_first_page(self):
+        self.assertEqual(fix_transclusion(self.text, 'Page:Vol.djvu/10', \
+            {'s1': 's2'}, 'en')[0], '<pages index="Vol.djvu" from=10 to=14 ' \
+            'fromsection=s2 tosection=s1 />')
+
+    def test_last_page(self):
+        self.assertEqual(fix_transclusion(self.text, 'Page:Vol.djvu/14', \
+            {'s1': 's2'}, 'en')[0], '<pages index="Vol.djvu" from=10 to=14 ' \
+            'fromsection=s1 tosection=s2 />')
+
+    def test_outside_range(self):
+        self.assertEqual(fix_transclusion(self.text, 'Page:Vol.djvu/15', \
+            {'s1': 's2'}, 'en'), (None, None))
+
+    def test_onlysection(self):
+        text = '<pages index="Vol.djvu" from=10 to=14 onlysection=s1 />'
+        self.assertEqual(fix_transclusion(text, 'Page:Vol.djvu/12', \
+            {'s1': 's2'}, 'en')[0], '<pages index="Vol.djvu" from=10 to=14 ' \
+            'onlysection=s2 />')
+
+    def test_without_page_number(self):
+        self.assertEqual(fix_transclusion(self.text, 'Page:Vol.djvu', \
+            {'s1': 's2'}, 'en')[0], '<pages index="Vol.djvu" from=10 to=14 ' \
+            'fromsection=s2 tosection=s2 />')
+
+
+class FixTargetTest(unittest.TestCase):
+
+    def test_renames_dont_chain(self):
+        # a->b on page 12 and b->c on page 13 in one edit
+        text = '<pages index="Vol.djvu" from=12 to=13 fromsection=a ' \
+            'tosection=b />'
+        content, pages, labels = lst_worker.fix_target(text, [page( \
+            'Page:Vol.djvu/12', {'a': 'b'}), page('Page:Vol.djvu/13', \
+            {'b': 'c'})])
+        self.assertEqual(content, '<pages index="Vol.djvu" from=12 to=13 ' \
+            'fromsection=b tosection=c />')
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(labels, [('a', 'b'), ('b', 'c')])
+
+    def test_no_change(self):
+        text = '{{#lst:Page:Vol.djvu/12|a}}'
+        self.assertEqual(lst_worker.fix_target(text, [page( \
+            'Page:Vol.djvu/13', {'a': 'b'})]), (text, [], []))
+
+
+if __name__ == '__main__':
+    unittest.main()